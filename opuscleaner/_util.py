@@ -1,5 +1,5 @@
 from typing import TypeVar, Optional, Generic
-from threading import Thread, Condition
+from threading import Thread, Condition, Lock
 from collections import deque
 from queue import SimpleQueue
 
@@ -79,36 +79,42 @@ class CancelableQueue(Generic[T]):
         self.capacity = capacity
         self.size = 0
         self.queue = deque()
-        self.cv = Condition()
+        # Two conditions on the same lock, so a put() only wakes up a waiting
+        # get() and vice versa, never another put() or get().
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
         self.cancelled = False
 
     def put(self, item: T):
         """put() blocks until there's space on the queue. Can raise `Cancelled`
         when `cancel()` was called.
         """
-        with self.cv:
-            self.cv.wait_for(lambda: self.cancelled or self.capacity is None or self.size < self.capacity)
+        with self.lock:
+            if self.capacity is not None:
+                self.not_full.wait_for(lambda: self.cancelled or self.size < self.capacity)
             if self.cancelled:
                 raise Cancelled()
             self.queue.append(item)
             self.size += 1
-            self.cv.notify()
+            self.not_empty.notify()
 
     def get(self) -> T:
         """blocking get(). Either returns an item from the queue, or raises
         `Cancelled`.
         """
-        with self.cv:
-            self.cv.wait_for(lambda: self.cancelled or self.size > 0)
+        with self.lock:
+            self.not_empty.wait_for(lambda: self.cancelled or self.size > 0)
             if self.cancelled:
                 raise Cancelled()
             self.size -= 1
             item = self.queue.popleft()
-            self.cv.notify()
+            self.not_full.notify()
         return item
     
     def cancel(self):
         """Makes all calls to `get()` and `put()` raise `Cancelled()`."""
-        with self.cv:
+        with self.lock:
             self.cancelled = True
-            self.cv.notify_all()    
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
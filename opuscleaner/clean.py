@@ -5,41 +5,68 @@ links them together through pipes. Can read from stdin but by default reads
 the dataset from the same folder as the pipeline configuration file.
 """
 import argparse
+import errno
+import heapq
 import json
 import os
 import re
+import selectors
 import signal
 import sys
 import traceback
 from queue import SimpleQueue
 from shlex import quote
-from shutil import copyfileobj
-from subprocess import Popen, PIPE
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from shutil import copyfileobj, which
+from subprocess import Popen, PIPE, TimeoutExpired
+from tempfile import TemporaryDirectory, TemporaryFile
 from threading import Thread
-from typing import Dict, List, IO, Optional, TypeVar, Iterable, Tuple, NamedTuple, Union
+from typing import Dict, List, IO, Optional, TypeVar, Iterable, Tuple, NamedTuple, Union, Set
+from uuid import UUID
 from io import TextIOWrapper
 
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
 from pydantic import parse_obj_as
 
 from opuscleaner import logging
 from opuscleaner.config import FILTER_PATH
-from opuscleaner.filters import list_filters, set_global_filters, filter_format_command, Filter, FilterPipeline, quote, format_shell
+from opuscleaner.filters import list_filters, set_global_filters, filter_format_command, filter_format_parameters, Filter, FilterPipeline, quote, format_shell
 from opuscleaner._util import none_throws, ThreadPool, CancelableQueue, Cancelled
 
 
-# Queue for printing lines to stdout or stderr. None means end of input.
-PrintQueue = SimpleQueue[Union[None,bytes]]
-
 # Control queue for communicating the return code of a child back to the parent.
 ControlQueue = SimpleQueue[Tuple[int,int]]
 
-# Batches to be processed. tuple[batch index,batch path]. None means end of input.
+# Batches to be processed. tuple[batch index,file descriptor]. The file
+# descriptor is owned by whoever takes it off the queue. None means end of input.
 # Using a Queue here to limit the maximum capacity.
-BatchQueue = CancelableQueue[Union[None,Tuple[int,str]]]
+BatchQueue = CancelableQueue[Union[None,Tuple[int,int]]]
+
+# Batches to be merged. tuple[batch index,file descriptor,size in bytes]. The
+# file descriptor is owned by whoever takes it off the queue. None means end of
+# input.
+MergeQueue = CancelableQueue[Union[None,Tuple[int,int,int]]]
+
 
-# Batches to be merged. Same format as BatchQueue
-MergeQueue = CancelableQueue[Union[None,Tuple[int,str]]]
+# Buffer size for the pipes between filter steps. Linux defaults to 64 KiB,
+# which means a context switch for every 64 KiB passed between two steps. Not
+# larger, because once a user's pipes hold more than `pipe-user-pages-soft`
+# (64 MiB by default), the kernel shrinks new pipes to a single page.
+PIPE_SIZE = 2**18
+
+
+def grow_pipe(fd:int, size:int=PIPE_SIZE) -> None:
+    """Asks the kernel for a `size` bytes buffer for pipe `fd`. Only a hint: does
+    nothing where `F_SETPIPE_SZ` isn't supported or the limits don't allow it.
+    """
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size) # type:ignore
+        except OSError:
+            pass
 
 
 def load_time(fh:IO[str]) -> Dict[str,float]:
@@ -51,47 +78,134 @@ def load_time(fh:IO[str]) -> Dict[str,float]:
     return time
 
 
-@logging.trace
-def babysit_child(n: int, child: Popen, name: str, print_queue: PrintQueue, ctrl_queue: ControlQueue, time_read_fd:Optional[int]=None) -> None:
-    """Thread that looks after a child process and passes (and prefixes) all of
-    its stderr to a queue. It will tell the parent thread about the end of the
-    child through the ctrl_queue.
-    """
-    try:
-        logging.update(n=n, pid=child.pid, args=child.args)
+class WatchedChild(NamedTuple):
+    n: int
+    name: str
+    process: Popen
+    ctrl_queue: ControlQueue
+    time_read_fd: Optional[int]
+    event_id: UUID
 
-        prefix = f'[{name}] '.encode()
 
-        for line in none_throws(child.stderr):
-            print_queue.put(prefix + line)
+class StderrPrinter:
+    """Context manager running a thread that reads the stderr of all children
+    through a single selector, and prints it line by line, prefixed with the
+    child's name, to `fout` in an orderly fashion. Once a child closes its
+    stderr, its exit is passed back to its pool through the pool's ctrl_queue.
+    Exiting the context waits for all watched children to finish.
+    """
+    fout: IO[bytes]
 
-        child.wait()
+    # Children to start watching. None means no more children will follow.
+    queue: 'SimpleQueue[Optional[WatchedChild]]'
 
-        logging.event('child_exited', retval=child.returncode)
+    def __init__(self, fout: IO[bytes]):
+        self.fout = fout
+        self.queue = SimpleQueue()
+        # Self-pipe to wake up the selector when there's something on `queue`
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        self.thread = Thread(target=self.run)
 
-        # If the command was wrapped by `time`, we want to read its output as
-        # well. It's written to a separate pipe as to not end up in the stderr
-        # of the main command.
-        if time_read_fd is not None:
-            with os.fdopen(time_read_fd, 'r') as fh:
-                logging.update(time=load_time(fh))
-    finally:
-        ctrl_queue.put((n, child.returncode))
+    def __enter__(self) -> 'StderrPrinter':
+        self.thread.start()
+        return self
 
+    def __exit__(self, *args) -> None:
+        self._put(None)
+        self.thread.join()
+        os.close(self.wakeup_read_fd)
+        os.close(self.wakeup_write_fd)
+
+    def watch(self, n: int, name: str, process: Popen, ctrl_queue: ControlQueue, time_read_fd:Optional[int]=None) -> None:
+        """Start printing the stderr of `process`, which must be a pipe. When it
+        is closed, `(n, returncode)` is put onto `ctrl_queue`."""
+        event_id = logging.event('child', n=n, pid=process.pid, args=process.args)
+        self._put(WatchedChild(n, name, process, ctrl_queue, time_read_fd, event_id))
+
+    def _put(self, child: Optional[WatchedChild]) -> None:
+        self.queue.put(child)
+        os.write(self.wakeup_write_fd, b'\0')
+
+    def run(self) -> None:
+        buffers: Dict[int,bytes] = {}
+        accepting = True
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.wakeup_read_fd, selectors.EVENT_READ)
+
+            # Keep going until we've been told to stop and all children are done
+            while accepting or len(selector.get_map()) > 1:
+                # Everything read in this round, written out in one go
+                output: List[bytes] = []
+
+                # Children that closed their stderr in this round
+                closed: List[WatchedChild] = []
+
+                for key, _ in selector.select():
+                    # New children to watch (or the end of them)
+                    if key.data is None:
+                        os.read(self.wakeup_read_fd, 4096)
+                        while not self.queue.empty():
+                            child = self.queue.get()
+                            if child is None:
+                                accepting = False
+                            else:
+                                fd = none_throws(child.process.stderr).fileno()
+                                selector.register(fd, selectors.EVENT_READ, child)
+                                buffers[fd] = b''
+                        continue
+
+                    child = key.data
+                    prefix = f'[{child.name}] '.encode()
+                    chunk = os.read(key.fd, 65536)
+                    lines = (buffers[key.fd] + chunk).split(b'\n')
+
+                    # Hold on to the last incomplete line until the rest comes in
+                    # or the child closes its stderr.
+                    buffers[key.fd] = lines.pop() if chunk else b''
+
+                    for line in lines:
+                        if line or chunk:
+                            output.append(prefix + line + b'\n')
+
+                    if not chunk:
+                        selector.unregister(key.fd)
+                        del buffers[key.fd]
+                        none_throws(child.process.stderr).close()
+                        closed.append(child)
+
+                # Since we're writing stderr, we flush after each round to make
+                # it more useful for debugging
+                if output:
+                    self.fout.write(b''.join(output))
+                    self.fout.flush()
+
+                # Only report exits once their last words have been printed
+                for child in closed:
+                    try:
+                        child.process.wait(timeout=0.1)
+                    except TimeoutExpired:
+                        # It closed stderr but kept running. Wait for it on
+                        # the side so we keep printing everyone else's.
+                        Thread(target=self._exited, args=[child]).start()
+                    else:
+                        self._exited(child)
+
+    def _exited(self, child: WatchedChild) -> None:
+        logger = logging.get_logger()
+        try:
+            child.process.wait()
 
-def print_lines(queue: PrintQueue, fout: IO[bytes]) -> None:
-    """Thread that prints stderr lines from all the children to stderr in an
-    orderly fashion.
-    """
-    while True:
-        line = queue.get()
-        if line is None:
-            break
-        fout.write(line)
+            logger.event('child_exited', parent=child.event_id, retval=child.process.returncode)
 
-        # Since we're writing stderr, we flush after each line to make it more
-        # useful for debugging
-        fout.flush()
+            # If the command was wrapped by `time`, we want to read its output as
+            # well. It's written to a separate pipe as to not end up in the stderr
+            # of the main command.
+            if child.time_read_fd is not None:
+                with os.fdopen(child.time_read_fd, 'r') as fh:
+                    logger.update(child.event_id, time=load_time(fh))
+        finally:
+            child.ctrl_queue.put((child.n, child.process.returncode))
 
 
 T = TypeVar('T')
@@ -112,14 +226,13 @@ def mark_last(iterable: Iterable[T]) -> Iterable[Tuple[bool,T]]:
 class Child(NamedTuple):
     name: str
     process: Popen
-    babysitter: Thread
 
 
 @logging.trace_context
 class ProcessPool:
     """Context manager for spawning and babysitting child processes that are
-    siblings connected by their pipes. Exiting the context will cause it to
-    block and wait for the children to finish.
+    siblings connected by their pipes. Their stderr is printed by `printer`.
+    Exiting the context will cause it to block and wait for the children to finish.
     If any of the children exits early or with an error, or there was an
     uncaught exception inside the context, it will terminate all the other
     processes in the pool and raise an exception on exit. SIGPIPE errors, and
@@ -129,24 +242,25 @@ class ProcessPool:
 
     ctrl_queue: ControlQueue
 
-    print_queue: PrintQueue
+    printer: StderrPrinter
 
+    # Environment for the children: `os.environ` with the pool's `env` applied
     environ: Dict[str,str]
 
     children: List[Child]
 
-    def __init__(self, print_queue: PrintQueue, *, env:Dict[str,str]={}, print_prefix:str=''):
+    def __init__(self, printer: StderrPrinter, *, env:Dict[str,str]={}, print_prefix:str=''):
         self.print_prefix = print_prefix
         self.ctrl_queue = SimpleQueue()
-        self.print_queue = print_queue
-        self.environ = dict(env)
+        self.printer = printer
+        self.environ = {**os.environ, **env}
         self.children = []
 
     def start(self, name:str, cmd: Union[str,List[str]], *, shell:bool=False, time:bool=False, **kwargs) -> Popen:
         """Set up a process in the pool. Similar to Popen. `name` is used for
         identifying the process in log messages and exceptions. `time` can be
         set to True to wrap the process in `/usr/bin/time`. Furthermore all
-        arguments to `Popen` are accepted.
+        arguments to `Popen` are accepted, but `stderr` has to be `PIPE`.
         """
         time_read_fd, time_write_fd = None, None
 
@@ -164,14 +278,16 @@ class ProcessPool:
             args = ['/usr/bin/time', '-p', '-o', f'/dev/fd/{time_write_fd}', *args]
             kwargs['pass_fds'] = (time_write_fd, *kwargs.get('pass_fds', tuple()))
         
-        child = Popen(args, **{
-            **kwargs,
-            'env': {
-                **os.environ,
-                **self.environ,
-                **(kwargs.get('env') or dict())
-            }
-        })
+        # Only copy the environment if this particular child needs changes to it
+        env = self.environ
+        if kwargs.get('env'):
+            env = {**env, **kwargs['env']}
+
+        child = Popen(args, **{**kwargs, 'env': env})
+
+        # The output of a child is usually the input of the next one
+        if child.stdout is not None:
+            grow_pipe(child.stdout.fileno())
 
         # If we have a time pipe, make sure we release our handle of the write
         # side. We just keep the read side.
@@ -179,9 +295,8 @@ class ProcessPool:
             os.close(time_write_fd)
 
         n = len(self.children)
-        thread = Thread(target=babysit_child, args=[n, child, name, self.print_queue, self.ctrl_queue, time_read_fd])
-        thread.start()
-        self.children.append(Child(name, child, thread))
+        self.children.append(Child(name, child))
+        self.printer.watch(n, name, child, self.ctrl_queue, time_read_fd)
         return child
 
     def __enter__(self) -> 'ProcessPool':
@@ -219,14 +334,11 @@ class ProcessPool:
                 child.process.terminate()
             pass
 
-        # Wait for all the processes to exit to prevent zombies
-        for child in self.children:
-            if child.process.returncode is None:
-                child.process.wait()
-
-        # Wait for the babysitters to exit, which happens when their process has stopped
-        for child in self.children:
-            child.babysitter.join()
+        # Wait for all the processes to exit to prevent zombies. The printer
+        # only reports an exit once it has read all of the child's stderr.
+        while running_children > 0:
+            self.ctrl_queue.get()
+            running_children -= 1
 
         # If we broke out of our ctrl_queue loop we did so because there was an issue
         # with one of the children. Let's raise that to the parent.
@@ -234,10 +346,110 @@ class ProcessPool:
             raise RuntimeError(f"Child {problem_child.name} (pid {problem_child.process.pid}) exited with {problem_child.process.returncode}")
 
 
+# Characters that make a command need a shell to run it when they're not
+# quoted. Quotes, backslashes and plain variable references are fine,
+# `split_command()` deals with those the same way sh does.
+SHELL_METACHARACTERS = frozenset('|<>$`*?~;&(){}[]#!\n')
+
+# `$NAME` or `${NAME}`, but none of the `${NAME:+...}` operators
+VARIABLE = re.compile(r'\$(?:([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z_][A-Za-z0-9_]*)\})')
+
+# Without quotes around it, sh splits a variable's value into words at these
+# and expands it if it looks like a glob.
+FIELD_SPLIT_OR_GLOB = frozenset(' \t\n*?[')
+
+# Characters a backslash escapes inside double quotes
+DOUBLE_QUOTE_ESCAPES = frozenset('$`"\\')
+
+
+def split_command(command: str, variables: Optional[Dict[str,str]] = None) -> Optional[List[str]]:
+    """Splits a shell command into an argument list that can be executed without
+    a shell. References to `variables` as `$NAME` or `${NAME}` are replaced by
+    their value. Returns None if the command uses any other shell features, such
+    as pipes, globs or `${NAME:+...}`, and does need a shell after all."""
+    if variables is None:
+        variables = {}
+
+    if '\n' in command: # line continuations, or multiple commands
+        return None
+
+    def expand(pos: int) -> Tuple[Optional[str], int]:
+        match = VARIABLE.match(command, pos)
+        if not match:
+            return None, pos
+        return variables.get(match.group(1) or match.group(2)), match.end()
+
+    argv: List[str] = []
+    word: Optional[str] = None # None until something starts a new word
+    pos = 0
+    while pos < len(command):
+        char = command[pos]
+        if char in ' \t':
+            if word is not None:
+                argv.append(word)
+                word = None
+            pos += 1
+        elif char == "'":
+            end = command.find("'", pos + 1)
+            if end == -1: # unbalanced quotes, let the shell complain about it
+                return None
+            word = (word or '') + command[pos+1:end]
+            pos = end + 1
+        elif char == '"':
+            word = word or ''
+            pos += 1
+            while pos < len(command) and command[pos] != '"':
+                char = command[pos]
+                if char == '\\' and command[pos+1:pos+2] in DOUBLE_QUOTE_ESCAPES:
+                    word += command[pos+1]
+                    pos += 2
+                elif char == '$':
+                    value, pos = expand(pos)
+                    if value is None:
+                        return None
+                    word += value
+                elif char == '`':
+                    return None
+                else:
+                    word += char
+                    pos += 1
+            if pos == len(command): # unbalanced quotes again
+                return None
+            pos += 1
+        elif char == '\\':
+            if pos + 1 == len(command):
+                return None
+            word = (word or '') + command[pos+1]
+            pos += 2
+        elif char == '$':
+            value, pos = expand(pos)
+            if value is None or FIELD_SPLIT_OR_GLOB.intersection(value):
+                return None
+            # Like sh, an empty value without quotes doesn't make a word
+            if value:
+                word = (word or '') + value
+        elif char in SHELL_METACHARACTERS:
+            return None
+        else:
+            word = (word or '') + char
+            pos += 1
+
+    if word is not None:
+        argv.append(word)
+
+    # `VAR=value cmd` sets an environment variable, that is also shell work.
+    if not argv or '=' in argv[0]:
+        return None
+
+    return argv
+
+
 class PipelineStep(NamedTuple):
     name: str
     command: str
     basedir: str
+    # `command` as argument list if it can run without a shell, see `split_command()`
+    argv: Optional[List[str]]
 
 
 class Pipeline:
@@ -262,21 +474,16 @@ class Pipeline:
         # Assert we have all filters we need
         assert set(step.filter for step in pipeline.filters) - set(filters.keys()) == set()
 
-        # Make sure the path to the python binary (and the installed utils)
-        # is in the PATH variable. If you load a virtualenv this happens by
-        # default, but if you call it with the virtualenv's python binary 
-        # directly it wont.
-        pyenv_bin_path = os.path.dirname(sys.executable)
-        os_env_bin_paths = os.environ.get('PATH', '').split(os.pathsep)
-        self.env: Optional[Dict[str,str]] = {
-            **os.environ,
-            'PATH': os.pathsep.join([pyenv_bin_path] + os_env_bin_paths)
-        } if pyenv_bin_path not in os_env_bin_paths else None
-
         for step in pipeline.filters:
             filter_def = filters[step.filter]
+            # A command uses its parameters as shell variables. If those are
+            # all plain `$NAME` references, `split_command()` fills them in
+            # and the step can run without a shell.
+            argv = split_command(
+                filter_format_command(filter_def, step, languages, with_parameters=False),
+                filter_format_parameters(filter_def, step))
             command_str = filter_format_command(filter_def, step, languages)
-            self.steps.append(PipelineStep(step.filter, command_str, filter_def.basedir))
+            self.steps.append(PipelineStep(step.filter, command_str, filter_def.basedir, argv))
 
     def run(self, pool:ProcessPool, stdin:IO[bytes], stdout:IO[bytes], *, tee:bool=False, basename:str="", time:bool=False) -> None:
         """Set up all the processes on `pool`, processing `stdin` to `stdout`.
@@ -285,20 +492,26 @@ class Pipeline:
         Optionally you can `tee` the output of each filter step to a separate
         file for debugging (with the name "{basename}.step-{i}.tsv". You can 
         use `time` two wrap every filter step command in `/usr/bin/time` and
-        the baby sitter will measure how much processing time the filter process
-        used."""
+        the pool will measure how much processing time the filter process
+        used.
+
+        Every step is started as its own child, instead of handing the whole
+        chain to a single `sh -c 'a | b | c'`. That way the pool sees the exit
+        status of each step (sh only reports the last one, and has no pipefail),
+        and stderr and timing can be attributed to the step that produced it.
+        Steps without shell syntax don't get a shell, see `split_command()`."""
         if not self.steps:
             copyfileobj(stdin, stdout)
             return
 
         for i, (is_last_step, step) in enumerate(mark_last(self.steps)):
-            child = pool.start(f'{pool.print_prefix}{i}:{step.name}', step.command,
+            child = pool.start(f'{pool.print_prefix}{i}:{step.name}', step.argv or step.command,
                 stdin=stdin,
                 stdout=stdout if is_last_step and not tee else PIPE,
                 stderr=PIPE,
                 cwd=step.basedir,
                 env=self.env,
-                shell=True,
+                shell=step.argv is None,
                 time=time)
 
             # Close our reference to the previous child, now taken over by the next child
@@ -332,41 +545,156 @@ class Pipeline:
 
 
 
-def split_input(parallel: int, batch_queue: BatchQueue, batch_size:int, stdin:IO[bytes]) -> None:
+def copy_fd(in_fd:int, size:int, fout:IO[bytes], *, sendfile:bool=True) -> bool:
+    """Copies the first `size` bytes of the file behind `in_fd` to `fout`. Uses
+    `os.sendfile()` so the data does not have to pass through Python, but falls
+    back to reading and writing if `fout` has no usable file descriptor or the
+    platform does not support sendfile between the two. Returns whether
+    sendfile can be used for `fout`; pass that as `sendfile` on the next call
+    to not try it again.
+    """
+    offset = 0
+
+    try:
+        out_fd = fout.fileno() if sendfile and hasattr(os, 'sendfile') else None
+    except (AttributeError, OSError): # io.UnsupportedOperation is an OSError
+        out_fd = None
+
+    if out_fd is not None:
+        # Anything written to `fout` through Python has to hit the fd before we
+        # start writing to it directly.
+        fout.flush()
+
+        try:
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as exc:
+            # Only fall back if sendfile itself is the problem, i.e. not for
+            # things like EPIPE or ENOSPC.
+            if exc.errno not in (errno.ENOSYS, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+            out_fd = None
+
+    while offset < size:
+        chunk = os.pread(in_fd, min(size - offset, 2**20), offset)
+        if not chunk:
+            break
+        fout.write(chunk)
+        offset += len(chunk)
+
+    return out_fd is not None
+
+
+def prefetch_fd(fd:int, size:int) -> None:
+    """Asks the kernel to start reading the first `size` bytes of the file behind
+    `fd` into the page cache, so they're there by the time we copy them. Only a
+    hint: does nothing where `posix_fadvise()` is unavailable or unsupported.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+def renice_thread(increment:int) -> None:
+    """Lowers the scheduling priority of the calling thread by `increment`. Only
+    use this on Linux, where niceness is a property of the thread. Elsewhere it
+    applies to the whole process.
+    """
+    if increment > 0:
+        os.nice(increment)
+
+
+def split_cpus(parallel:int) -> List[Set[int]]:
+    """Divides the CPUs this process may run on into `parallel` sets. If there
+    are fewer CPUs than sets, CPUs are shared round-robin.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if parallel > len(cpus):
+        return [{cpus[n % len(cpus)]} for n in range(parallel)]
+    return [set(cpus[n::parallel]) for n in range(parallel)]
+
+
+# Number of bytes `split_input()` reads from its input at a time
+SPLIT_CHUNK_SIZE = 2**20
+
+
+def batch_file(in_memory:bool=False) -> IO[bytes]:
+    """Opens an anonymous read/write file for a batch. Normally that's a file in
+    TMPDIR; with `in_memory` it is a memfd that lives in RAM only (Linux only).
+    """
+    if in_memory:
+        return open(os.memfd_create('opuscleaner-batch'), 'w+b')
+    return TemporaryFile()
+
+
+def split_input(parallel: int, batch_queue: BatchQueue, batch_size:int, stdin:IO[bytes], *, nice:int=0, in_memory:bool=False) -> None:
     """Reads data from `stdin` and splits it into chunks of `batch_size` lines.
-    These chunks are stored in temporary files, whose filenames are put onto
-    `batch_queue`.
+    These chunks are stored in anonymous files (see `batch_file()`), whose file
+    descriptors are put onto `batch_queue`. Whoever takes a descriptor off the
+    queue owns it. `nice` lowers the priority of the thread, see `renice_thread()`.
+
+    This runs fine as a thread next to the others: it spends its time in
+    `readinto()` and `write()`, which release the GIL, and in counting the
+    newlines of a whole chunk in a single `bytearray.count()` call.
     """
+    renice_thread(nice)
+
     more = True
 
     batch_index = 0
 
+    # Read stdin in large chunks and only look for individual newlines in the
+    # chunk that contains the end of a batch. `buffer[start:end]` is what has
+    # been read but not yet written to a batch.
+    buffer = bytearray(SPLIT_CHUNK_SIZE)
+    view = memoryview(buffer)
+    start, end = 0, 0
+
     while more:
-        fh = NamedTemporaryFile(delete=False)
-        
         lines = 0
 
-        while lines < batch_size:
-            line = stdin.readline()
-            if line == b'':
-                more = False
+        with batch_file(in_memory) as fh:
+            while lines < batch_size:
+                if start == end:
+                    start, end = 0, stdin.readinto(buffer)
+                    if not end:
+                        more = False
+                        break
+
+                stop = end
+                count = buffer.count(b'\n', start, end)
+
+                # Does this batch end in this chunk? Then only write up to and
+                # including the newline of its last line.
+                if lines + count >= batch_size:
+                    count = batch_size - lines
+                    stop = start
+                    for _ in range(count):
+                        stop = buffer.find(b'\n', stop, end) + 1
+
+                fh.write(view[start:stop])
+                lines += count
+                start = stop
+
+            # Empty chunk because `len(stdin) % batch_size == 0`. No need
+            # to process it further.
+            if fh.tell() == 0:
                 break
-            fh.write(line)
-            lines += 1
-        
-        fh.close()
 
-        try:    
-            if lines > 0:
-                batch_queue.put((batch_index, fh.name))
-            else:
-                # Empty chunk because `len(stdin) % batch_size == 0`. No need
-                # to process it further.
-                os.unlink(fh.name)
+            fh.seek(0)
+            fd = os.dup(fh.fileno())
+
+        try:
+            batch_queue.put((batch_index, fd))
         except Cancelled:
-            # batch_queue got interrupted, so fn.name never made it into the
+            # batch_queue got interrupted, so fd never made it into the
             # queue. Let's clean that up.
-            os.unlink(fh.name)
+            os.close(fd)
             raise
 
         batch_index += 1
@@ -377,10 +705,13 @@ def split_input(parallel: int, batch_queue: BatchQueue, batch_size:int, stdin:IO
 
 
 @logging.trace
-def run_pipeline(print_queue:PrintQueue, batch_queue:BatchQueue, merge_queue:MergeQueue, pipeline:Pipeline, *, time:bool=False) -> None:
-    """Receives an input filename from `batch_queue`, and once that has been processed
-    with `pipeline`, it will post the output filename to `merge_queue`.
-    stderr from any of the filter processes will be forwarded to `print_queue`.
+def run_pipeline(printer:StderrPrinter, batch_queue:BatchQueue, merge_queue:MergeQueue, pipeline:Pipeline, *, time:bool=False, cpus:Optional[Set[int]]=None, in_memory:bool=False) -> None:
+    """Receives an input file descriptor from `batch_queue`, and once that has been
+    processed with `pipeline`, it will post a file descriptor of the output to
+    `merge_queue`. stderr from any of the filter processes will be printed by
+    `printer`. If `cpus` is given, this thread and the filter processes it
+    starts will only run on those CPUs (Linux only). With `in_memory` the output
+    is kept in a memfd instead of a file in TMPDIR.
 
     TODO: This could also instead run ./run.py on the input and output files
     directly as opposed to using `ProcessPool` + `pipeline.run()`.
@@ -389,7 +720,18 @@ def run_pipeline(print_queue:PrintQueue, batch_queue:BatchQueue, merge_queue:Mer
     actual filtering pipeline is executed on a different node. Since input
     and output are just files on the same filesystem (depends on TMPDIR) this
     should pretty much work out of the box :O
+
+    Note that the filter processes are started anew for every batch. Keeping
+    them running between batches would save on their start-up cost (e.g.
+    loading models), but filters are free to drop or add lines, so the end of
+    their output is the only reliable marker of where a batch ends. Use a larger
+    `batch_size` if start-up cost dominates.
     """
+    # On Linux, affinity set for pid 0 applies to this thread only, and is
+    # inherited by the children it spawns.
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
     with TemporaryDirectory() as tmpdir:
         while True:
             entry = batch_queue.get()
@@ -398,105 +740,127 @@ def run_pipeline(print_queue:PrintQueue, batch_queue:BatchQueue, merge_queue:Mer
             if entry is None:
                 break
 
-            batch_index, filename = entry
+            batch_index, batch_fd = entry
 
             try:
-                # Write pipeline output to tempfile that is then passed on to merger.
-                stdout = NamedTemporaryFile(delete=False)
-
-                try:
-                    # Open chunk file and process pool and run the pipeline with it.
+                # Write pipeline output to an anonymous file. We hand its
+                # file descriptor to the merger, so it doesn't need to reopen it.
+                with open(batch_fd, 'rb') as stdin, batch_file(in_memory) as stdout:
+                    # Run the pipeline on the chunk in a fresh process pool.
                     # The pool's __exit__() will make us wait till the pipeline is done.
                     with logging.span('run_pipeline_batch', batch_index=batch_index), \
-                        open(filename, 'rb') as stdin, \
-                        ProcessPool(print_queue, env={'TMPDIR': tmpdir}, print_prefix=f'{batch_index}/') as pool:
+                        ProcessPool(printer, env={'TMPDIR': tmpdir}, print_prefix=f'{batch_index}/') as pool:
                         pipeline.run(pool, stdin, stdout, time=time)
 
-                    stdout.close()
+                    # Seeking to the end also flushes anything written through
+                    # `stdout` itself, i.e. when the pipeline has no steps.
+                    size = stdout.seek(0, os.SEEK_END)
+                    fd = os.dup(stdout.fileno())
 
+                try:
                     # Tell merger that they can process this batch when the time comes
-                    merge_queue.put((batch_index, stdout.name))
-                except Exception as exc:
-                    # Didn't get to put it on the queue, delete it.
-                    os.unlink(stdout.name)
+                    merge_queue.put((batch_index, fd, size))
+                except:
+                    # Didn't get to put it on the queue, close it.
+                    os.close(fd)
                     raise
             except Exception as exc:
                 # Add a bit more info, and re-raise
                 raise RuntimeError(f'Error while processing batch {batch_index}') from exc
-            finally:
-                # Delete the input file from disk.
-                os.unlink(filename)
         
         # Tell the merger that they should not be expecting more input from you.
         merge_queue.put(None)
 
 
-def merge_output(parallel:int, merge_queue:MergeQueue, stdout:IO[bytes]) -> None:
-    """Takes batch filenames and numbers from `merge_queue` and will concatenate
-    files in the order of the batches. If batches arrive out of order, it will
-    wait for the next in order batch to arrive before continuing to concatenate.
+def merge_output(parallel:int, merge_queue:MergeQueue, stdout:IO[bytes], *, nice:int=0) -> None:
+    """Takes batch file descriptors and numbers from `merge_queue` and will
+    concatenate files in the order of the batches. If batches arrive out of
+    order, it will wait for the next in order batch to arrive before continuing
+    to concatenate. `nice` lowers the priority of the thread, see `renice_thread()`.
     """
+    renice_thread(nice)
+
     next_batch_index = 0
 
-    pending_batches: Dict[int, str] = {}
+    # Min-heap of batches that arrived but are not yet next in line, ordered by
+    # batch index. Same tuples as the ones that come from `merge_queue`.
+    pending_batches: List[Tuple[int,int,int]] = []
 
-    while True:
-        # If we have the next batch, start processing it into the final output
-        if next_batch_index in pending_batches:
-            batch_index, filename = next_batch_index, pending_batches[next_batch_index]
+    # Whether `copy_fd()` can still use sendfile to write to `stdout`
+    sendfile = True
 
-            try:
-                with logging.span(f'merge_output_batch', batch_index=batch_index), open(filename, 'rb') as fh:
-                    copyfileobj(fh, stdout)
-            except Exception as exc:
-                raise RuntimeError(f'Error while merging batch {batch_index}') from exc
-            finally:
-                os.unlink(filename)
+    try:
+        while True:
+            # Write all the pending batches that are next in line to the final output
+            while pending_batches and pending_batches[0][0] == next_batch_index:
+                batch_index, fd, size = heapq.heappop(pending_batches)
+
+                # If the batch after this one is also here, have the kernel read
+                # it back in while we're busy copying this one.
+                if pending_batches and pending_batches[0][0] == next_batch_index + 1:
+                    prefetch_fd(pending_batches[0][1], pending_batches[0][2])
 
-            next_batch_index += 1
-        # If not yet, we wait on the queue to come through with (hopefully) the next batch
-        elif parallel > 0:
+                try:
+                    with logging.span(f'merge_output_batch', batch_index=batch_index):
+                        sendfile = copy_fd(fd, size, stdout, sendfile=sendfile)
+                except Exception as exc:
+                    raise RuntimeError(f'Error while merging batch {batch_index}') from exc
+                finally:
+                    os.close(fd)
+
+                next_batch_index += 1
+
+            # There are no more batches coming from any batch processors. So
+            # let's stop.
+            if parallel == 0:
+                break
+
+            # Wait on the queue to come through with (hopefully) the next batch
             entry = merge_queue.get()
 
             # Another batch processor finished
             if entry is None:
                 parallel -= 1
             else:
-                batch_index, filename = entry
-                assert batch_index not in pending_batches
-                pending_batches[batch_index] = filename
-        # next_batch_index is not in pending_batches, and there are no more batches coming from
-        # any batch processors. So let's stop.
-        else:
-            break
+                assert entry[0] >= next_batch_index
+                heapq.heappush(pending_batches, entry)
 
-    if len(pending_batches) and next_batch_index <= max(pending_batches.keys()):
-        raise RuntimeError(f'Not all batches got merged: {next_batch_index=} <= {max(pending_batches.keys())=}')
+        if pending_batches:
+            raise RuntimeError(f'Not all batches got merged: {next_batch_index=} < {pending_batches[0][0]=}')
+    finally:
+        for _, fd, _ in pending_batches:
+            os.close(fd)
 
 
 @logging.trace
-def run_parallel(pipeline:Pipeline, stdin:IO[bytes], stdout:IO[bytes], *, parallel:int, batch_size:int, print_queue: PrintQueue, time:bool=False) -> None:
+def run_parallel(pipeline:Pipeline, stdin:IO[bytes], stdout:IO[bytes], *, parallel:int, batch_size:int, printer: StderrPrinter, time:bool=False, pin_cpus:bool=False, in_memory:bool=False) -> None:
     """Run `parallel` copies of the processing pipeline in parallel, each
     working on a batch of `batch_size` lines at a time. Batches will be cut
     from `stdin` and printed to `stdout`, in order. stderr from the filter
-    processes will be forwarded to `print_queue`. `time` is forwarded to
-    ProcessPool.
+    processes will be printed by `printer`. `time` is forwarded to
+    ProcessPool. With `pin_cpus` each copy gets its own share of the CPUs, and
+    the splitting and merging threads run at a lower priority (Linux only).
+    With `in_memory` batches are kept in RAM instead of TMPDIR (Linux only).
     """
     batch_queue: BatchQueue = CancelableQueue(parallel * 2)
 
     merge_queue: MergeQueue = CancelableQueue()
 
+    cpus = split_cpus(parallel) if pin_cpus else [None] * parallel
+
+    nice = 5 if pin_cpus else 0
+
     with ThreadPool() as pool:
         # Splits stdin into files of `batch_size` lines, and puts those on `batch_queue`
-        pool.start(split_input, parallel, batch_queue, batch_size, stdin)
+        pool.start(split_input, parallel, batch_queue, batch_size, stdin, nice=nice, in_memory=in_memory)
 
-        # Read `batch_queue` for batch filenames, and process them. Put output files
+        # Read `batch_queue` for batch files, and process them. Put output files
         # on `merge_queue`.
-        for _ in range(parallel):
-            pool.start(run_pipeline, print_queue, batch_queue, merge_queue, pipeline, time=time)
+        for n in range(parallel):
+            pool.start(run_pipeline, printer, batch_queue, merge_queue, pipeline, time=time, cpus=cpus[n], in_memory=in_memory)
 
         # Read from `merge_queue` and combine files in order.
-        pool.start(merge_output, parallel, merge_queue, stdout)
+        pool.start(merge_output, parallel, merge_queue, stdout, nice=nice)
 
         try:
             pool.join()
@@ -506,6 +870,16 @@ def run_parallel(pipeline:Pipeline, stdin:IO[bytes], stdout:IO[bytes], *, parall
             raise
 
 
+def gunzip_command() -> List[str]:
+    """Command that decompresses a gzip file to stdout. Uses `pigz` if it is
+    installed, which does reading, writing and checksumming on separate threads,
+    and is a drop-in replacement for `gzip` otherwise.
+    """
+    if which('pigz'):
+        return ['pigz', '-cd']
+    return ['gzip', '-cd']
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('--filters', '-f', type=str, default=FILTER_PATH, help='Path to directory with filter specifications')
@@ -519,6 +893,8 @@ def main() -> None:
     parser.add_argument('--dump', action='store_true', help='Print shell script instead')
     parser.add_argument('--trace', type=argparse.FileType('a'), nargs='?', const='/dev/stderr', help='Write tracing JSON to file (defaults to stderr)')
     parser.add_argument('--time', action='store_true', help='Measure real/user/sys times for each filter step')
+    parser.add_argument('--pin-cpus', action='store_true', help='Give each parallel copy of the pipeline its own share of the CPUs (only if --parallel > 1, Linux only)')
+    parser.add_argument('--parallel-inmemory', action='store_true', help='Keep batches in memory instead of in TMPDIR (only if --parallel > 1, Linux only)')
     parser.add_argument('pipeline', metavar='PIPELINE', type=argparse.FileType('r'), help='Pipeline steps specification file, e.g. *.filters.json')
     parser.add_argument('languages', metavar='LANG', type=str, nargs='*', help='Language codes of the columns in the input TSV. Only used when --input is set')
 
@@ -536,6 +912,12 @@ def main() -> None:
         if args.tee and args.parallel > 1:
             parser.error('Using --tee is not supported when using --parallel')
 
+        if args.pin_cpus and (args.parallel < 2 or sys.platform != 'linux'):
+            parser.error('Using --pin-cpus is only supported on Linux, together with --parallel')
+
+        if args.parallel_inmemory and (args.parallel < 2 or not hasattr(os, 'memfd_create')):
+            parser.error('Using --parallel-inmemory is only supported on Linux, together with --parallel')
+
         if args.time and not args.trace:
             parser.error('You need to use --trace to see the output of --time')
 
@@ -568,70 +950,67 @@ def main() -> None:
             pipeline.dump(TextIOWrapper(stdout))
             sys.exit(0)
 
-        # Queue filled by the babysitters with the stderr of the children, consumed
-        # by `print_lines()` to prevent racing on stderr.
-        print_queue = SimpleQueue() # type: SimpleQueue[Optional[bytes]]
-
-        # First start the print thread so that we get immediate feedback from the
-        # children even if all of them haven't started yet.
-        print_thread = Thread(target=print_lines, args=[print_queue, sys.stderr.buffer])
-        print_thread.start()
-
-        # Start child processes, each reading the output from the previous sibling
-        try:
-            with ProcessPool(print_queue) as pool:
-                # If we're not reading from stdin, read from files and paste them together
-                if args.input:
-                    stdin = args.input
-                else:
-                    # Open `gzunip` for each language file
-                    gunzips = [
-                        pool.start(f'gunzip {filename}',
-                            ['gzip', '-cd', filename],
+        # Thread that reads the stderr of all the children and prints it to
+        # our stderr, to prevent racing on stderr. Started first so that we get
+        # immediate feedback from the children even if all of them haven't
+        # started yet. Leaving the block waits for all children to finish.
+        with StderrPrinter(sys.stderr.buffer) as printer:
+            # Start child processes, each reading the output from the previous sibling
+            try:
+                with ProcessPool(printer) as pool:
+                    # If we're not reading from stdin, read from files and paste them together
+                    if args.input:
+                        stdin = args.input
+                    else:
+                        # Open `gzunip` for each language file
+                        gunzip = gunzip_command()
+                        gunzips = [
+                            pool.start(f'gunzip {filename}',
+                                [*gunzip, filename],
+                                stdout=PIPE,
+                                stderr=PIPE,
+                                cwd=args.basedir)
+                            for filename in pipeline_config.files
+                        ]
+
+                        # A single file needs no combining, read it straight from `gunzip`
+                        if len(gunzips) == 1:
+                            stdin = none_throws(gunzips[0].stdout)
+                        else:
+                            fds = [none_throws(gunzip.stdout).fileno() for gunzip in gunzips]
+
+                            # .. and a `paste` to combine them into columns
+                            paste = pool.start('paste',
+                                ['paste'] + [f'/dev/fd/{fd}' for fd in fds],
+                                stdout=PIPE,
+                                stderr=PIPE,
+                                pass_fds=fds)
+
+                            # Now that `paste` has inherited all the children, close our connection to them
+                            for gunzip in gunzips:
+                                none_throws(gunzip.stdout).close()
+
+                            stdin = none_throws(paste.stdout)
+
+                    # If we only want the first N lines processed, use `head` to chop those off.
+                    if args.first > 0:
+                        head = pool.start('head',
+                            ['head', '-n', str(args.first)],
+                            stdin=stdin,
                             stdout=PIPE,
-                            stderr=PIPE,
-                            cwd=args.basedir)
-                        for filename in pipeline_config.files
-                    ]
-
-                    fds = [none_throws(gunzip.stdout).fileno() for gunzip in gunzips]
-
-                    # .. and a `paste` to combine them into columns
-                    paste = pool.start('paste',
-                        ['paste'] + [f'/dev/fd/{fd}' for fd in fds],
-                        stdout=PIPE,
-                        stderr=PIPE,
-                        pass_fds=fds)
-
-                    # Now that `paste` has inherited all the children, close our connection to them
-                    for gunzip in gunzips:
-                        none_throws(gunzip.stdout).close()
-
-                    stdin = none_throws(paste.stdout)
-
-                # If we only want the first N lines processed, use `head` to chop those off.
-                if args.first > 0:
-                    head = pool.start('head',
-                        ['head', '-n', str(args.first)],
-                        stdin=stdin,
-                        stdout=PIPE,
-                        stderr=PIPE)
-
-                    stdin.close() # now taken over by `head`.
-                    stdin = none_throws(head.stdout)
-
-                if args.parallel > 1:
-                    run_parallel(pipeline, stdin, stdout, print_queue=print_queue, parallel=args.parallel, batch_size=args.batch_size, time=args.time)
-                else:
-                    pipeline.run(pool, stdin, stdout, tee=args.tee, basename=basename, time=args.time)
-        except:
-            # If we didn't cleanly exit all processes, we err as well
-            traceback.print_exc(file=sys.stderr)
-            sys.exit(1)
-        finally:
-            # Tell print thread to stop (there are no more babysitters now to produce printable stuff)
-            print_queue.put(None)
-            print_thread.join()
+                            stderr=PIPE)
+
+                        stdin.close() # now taken over by `head`.
+                        stdin = none_throws(head.stdout)
+
+                    if args.parallel > 1:
+                        run_parallel(pipeline, stdin, stdout, printer=printer, parallel=args.parallel, batch_size=args.batch_size, time=args.time, pin_cpus=args.pin_cpus, in_memory=args.parallel_inmemory)
+                    else:
+                        pipeline.run(pool, stdin, stdout, tee=args.tee, basename=basename, time=args.time)
+            except:
+                # If we didn't cleanly exit all processes, we err as well
+                traceback.print_exc(file=sys.stderr)
+                sys.exit(1)
 
 
 if __name__ == '__main__':
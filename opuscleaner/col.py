@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
+import os
+import selectors
 import sys
+from collections import deque
+from itertools import islice
+from operator import itemgetter
 from subprocess import Popen, PIPE
-from threading import Thread
-from queue import SimpleQueue
-from typing import BinaryIO, Optional, TypeVar, List
+from typing import BinaryIO, Deque, Optional, TypeVar, List, Union
 
 
-queue = SimpleQueue() # type: SimpleQueue[None|list[bytes]]
+# Stop reading input while this many bytes are still waiting to be written to
+# the subprocess.
+MAX_PENDING = 2**20
+
+# Number of bytes read from the input or the subprocess at a time
+CHUNK_SIZE = 2**16
+
+# Most buffers passed to a single writev() call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
 
 T = TypeVar("T")
 
@@ -20,78 +31,218 @@ def parse_columns(text:str) -> List[int]:
 	return sorted(int(col) for col in text.split(','))
 
 
-class RaisingThread(Thread):
-	"""Thread that will raise any uncaught exceptions in the thread in the
-	parent once it joins again."""
+class LineBuffer:
+	"""Splits chunks of bytes into lines without their line endings. Holds on
+	to the last incomplete line until the rest of it comes in. Splitting a whole
+	chunk at once is a lot cheaper than reading line by line."""
 
-	exception: Optional[Exception]
+	remainder: bytes
 
-	def run(self):
-		self.exception = None
-		try:
-			super().run()
-		except Exception as exc:
-			self.exception = exc
+	def __init__(self):
+		self.remainder = b''
 
-	def join(self, timeout:Optional[float]=None):
-		super().join(timeout=timeout)
-		if self.exception is not None:
-			raise self.exception
+	def feed(self, chunk:bytes) -> List[bytes]:
+		"""Returns the lines completed by `chunk`. An empty chunk means end of
+		input, which completes a last line without trailing newline."""
+		if not chunk:
+			lines = [self.remainder.rstrip(b'\r')] if self.remainder else []
+			self.remainder = b''
+			return lines
+		buffer = self.remainder + chunk
+		lines = buffer.split(b'\n')
+		self.remainder = lines.pop()
+		# Look in all of `buffer`: a \r\n might be split over two chunks.
+		if b'\r' in buffer:
+			lines = [line.rstrip(b'\r') for line in lines]
+		return lines
 
 
-def split(columns:List[int], queue:'SimpleQueue[None|list[bytes]]', fin:BinaryIO, fout:BinaryIO):
-	try:
-		field_count = None
-		passthru_columns = []
-		for line in fin:
-			fields = line.rstrip(b'\r\n').split(b'\t')
-			if field_count is None:
-				field_count = len(fields)
-				passthru_columns = [n for n in range(field_count) if n not in columns]
-			elif field_count != len(fields):
-				raise RuntimeError(f'line contains a different number of fields: {len(fields)} vs {field_count}')
-			queue.put([fields[column] for column in passthru_columns])
-			for column in columns:
-				fout.write(fields[column] + b'\n')
-	except BrokenPipeError:
-		pass
-	finally:
-		try:
-			fout.close() # might fail if BrokenPipeError
-		except:
-			pass
-		queue.put(None) # End indicator
-		fin.close()
+def set_events(selector:selectors.BaseSelector, fd:int, events:int) -> None:
+	"""Makes `selector` watch `fd` for `events`, or not at all if there are none."""
+	key = selector.get_map().get(fd)
+	if not events:
+		if key is not None:
+			selector.unregister(fd)
+	elif key is None:
+		selector.register(fd, events)
+	elif key.events != events:
+		selector.modify(fd, events)
 
 
-def merge(columns:List[int], queue:'SimpleQueue[None|list[bytes]]', fin:BinaryIO, fout:BinaryIO):
-	try:
-		while True:
-			passthru_fields = queue.get()
-			if passthru_fields is None:
-				if fin.readline() != b'':
-					raise RuntimeError('subprocess produced more lines of output than it was given')
-				break
-
-			passthru_it = iter(passthru_fields)
-			for column in range(len(passthru_fields) + len(columns)):
-				if column in columns:
-					field = fin.readline()
-					if field == b'':
-						raise RuntimeError('subprocess produced fewer lines than it was given')
-					field = field.rstrip(b'\r\n')
-				else:
-					field = next(passthru_it)
-
-				if column > 0:
-					fout.write(b'\t')
-				fout.write(field)
-			fout.write(b'\n')
-	except BrokenPipeError:
-		pass
-	finally:
-		fout.close()
-		fin.close()
+def col(columns:List[int], fin:int, child:Popen, fout:BinaryIO) -> None:
+	"""Passes `columns` of each line of the TSV read from `fin` to `child`, and
+	writes those lines to `fout` with the columns replaced by what `child`
+	produced. Runs on a single thread, using a selector to feed the child and
+	read its output at the same time without either side blocking the other.
+	"""
+	child_in = none_throws(child.stdin)
+	child_out = none_throws(child.stdout)
+	child_in_fd = child_in.fileno()
+	child_out_fd = child_out.fileno()
+	os.set_blocking(child_in_fd, False)
+	os.set_blocking(child_out_fd, False)
+
+	field_count = None
+
+	# Input lines with the selected fields replaced by None, waiting for the
+	# child's output to fill them back in. The ones before `passthru_start` are
+	# done.
+	passthru_rows: List[List[Optional[bytes]]] = []
+	passthru_start = 0
+
+	# Lines of output of the child not yet matched with a passthru row
+	output_fields: List[bytes] = []
+
+	# Buffers still to be written to the child, one per chunk of input. Kept
+	# apart and handed to writev() so they're not copied into one big buffer.
+	pending: Deque[Union[bytes, memoryview]] = deque()
+	pending_size = 0
+
+	input_lines = LineBuffer()
+	output_lines = LineBuffer()
+
+	# Error to raise once the child is done. We don't bail out right away: the
+	# child might then die of a broken pipe, and its exit code would hide this.
+	error: Optional[Exception] = None
+
+	reading = True # still reading from `fin`
+	writing = True # still writing to `child_in`
+
+	# PollSelector because unlike epoll it accepts regular files, which
+	# stdin might be.
+	with (selectors.PollSelector() if hasattr(selectors, 'PollSelector') else selectors.DefaultSelector()) as selector:
+		while not child_out.closed:
+			# Closing the child's stdin tells it there is no more input
+			if writing and not reading and not pending:
+				set_events(selector, child_in_fd, 0)
+				child_in.close()
+				writing = False
+
+			set_events(selector, fin, selectors.EVENT_READ if reading and pending_size < MAX_PENDING else 0)
+			if writing:
+				set_events(selector, child_in_fd, selectors.EVENT_WRITE if pending else 0)
+			set_events(selector, child_out_fd, selectors.EVENT_READ)
+
+			for key, _ in selector.select():
+				if key.fd == fin:
+					chunk = os.read(fin, CHUNK_SIZE)
+					if not chunk:
+						reading = False
+					rows = [line.split(b'\t') for line in input_lines.feed(chunk)]
+					if not rows:
+						continue
+
+					if field_count is None:
+						field_count = len(rows[0])
+						if columns[-1] >= field_count:
+							error = RuntimeError(f'column {columns[-1]} out of range: line has {field_count} fields')
+							reading = False
+							del rows[:]
+
+					# Only process the rows up to the first one that doesn't fit.
+					if any(len(row) != field_count for row in rows):
+						n, row = next((n, row) for n, row in enumerate(rows) if len(row) != field_count)
+						error = error or RuntimeError(f'line contains a different number of fields: {len(row)} vs {field_count}')
+						reading = False
+						del rows[n:]
+
+					if not rows:
+						continue
+
+					# Take the selected fields out, leaving a hole for the child's
+					# output to go in. What remains is passed through.
+					if len(columns) == 1:
+						column = columns[0]
+						fields = list(map(itemgetter(column), rows))
+						for row in rows:
+							row[column] = None
+					else:
+						fields = [field for selected in map(itemgetter(*columns), rows) for field in selected]
+						for row in rows:
+							for column in columns:
+								row[column] = None
+					passthru_rows.extend(rows)
+					fields.append(b'') # ends join() with a newline
+					buffer = b'\n'.join(fields)
+					pending.append(buffer)
+					pending_size += len(buffer)
+
+				elif key.fd == child_in_fd:
+					try:
+						written = os.writev(key.fd, list(islice(pending, IOV_MAX)))
+						pending_size -= written
+						# Drop what's been written, and the start of a buffer that only
+						# made it partially.
+						while written:
+							if len(pending[0]) <= written:
+								written -= len(pending.popleft())
+							else:
+								pending[0] = memoryview(pending[0])[written:]
+								written = 0
+					except BlockingIOError:
+						pass
+					except BrokenPipeError:
+						# Child stopped reading. Stop feeding it, but keep reading
+						# what it did produce.
+						selector.unregister(key.fd)
+						child_in.close()
+						writing, reading = False, False
+						pending.clear()
+						pending_size = 0
+
+				elif key.fd == child_out_fd:
+					try:
+						chunk = os.read(key.fd, CHUNK_SIZE)
+					except BlockingIOError:
+						continue
+					output_fields += output_lines.feed(chunk)
+
+					# Match up as many complete rows as we've got output for
+					n = min(len(output_fields) // len(columns), len(passthru_rows) - passthru_start)
+					rows = passthru_rows[passthru_start:passthru_start + n]
+					passthru_start += n
+
+					# Fill the holes we left with the output fields
+					if len(columns) == 1:
+						column = columns[0]
+						for row, field in zip(rows, output_fields):
+							row[column] = field
+					else:
+						# zip() stops at the end of `columns` before taking a field
+						# from `fields_it`, so each row picks up where the last left off.
+						fields_it = iter(output_fields)
+						for row in rows:
+							for column, field in zip(columns, fields_it):
+								row[column] = field
+					del output_fields[:n * len(columns)]
+
+					if rows:
+						merged = list(map(b'\t'.join, rows))
+						merged.append(b'')
+						fout.write(b'\n'.join(merged))
+
+					# Drop the rows we're done with every now and then
+					if passthru_start > len(passthru_rows) // 2:
+						del passthru_rows[:passthru_start]
+						passthru_start = 0
+
+					if len(output_fields) >= len(columns):
+						error = error or RuntimeError('subprocess produced more lines of output than it was given')
+						output_fields.clear()
+
+					if not chunk:
+						selector.unregister(key.fd)
+						child_out.close()
+						if error is None and (passthru_start < len(passthru_rows) or output_fields):
+							error = RuntimeError('subprocess produced fewer lines than it was given')
+
+	if writing:
+		child_in.close()
+
+	fout.flush()
+
+	if error is not None:
+		raise error
 
 
 def main():
@@ -100,21 +251,28 @@ def main():
 	try:
 		columns = parse_columns(sys.argv[1])
 
-		child = Popen(sys.argv[2:], stdin=PIPE, stdout=PIPE)
+		# Unbuffered: `col()` reads and writes the pipes' file descriptors directly
+		child = Popen(sys.argv[2:], stdin=PIPE, stdout=PIPE, bufsize=0)
 
-		feeder = RaisingThread(target=split, args=[columns, queue, sys.stdin.buffer, none_throws(child).stdin])
-		feeder.start()
-
-		consumer = RaisingThread(target=merge, args=[columns, queue, none_throws(child).stdout, sys.stdout.buffer])
-		consumer.start()
+		try:
+			col(columns, sys.stdin.fileno(), child, sys.stdout.buffer)
+		except BrokenPipeError:
+			# Our output got closed. Stop the child the same way.
+			none_throws(child.stdout).close()
+			none_throws(child.stdin).close()
+			error = None
+		except Exception as exc:
+			error = exc
+		else:
+			error = None
 
 		retval = child.wait()
-		
+
 		if retval != 0:
 			raise RuntimeError(f'subprocess exited with status code {retval}')
 
-		feeder.join()
-		consumer.join()
+		if error is not None:
+			raise error
 	except Exception as e:
 		print(f'Error: {e}', file=sys.stderr)
 		sys.exit(retval or 1)
@@ -18,6 +18,24 @@ DEFAULT_CATEGORIES = [
 # thing. I'm now used to also have a data/clean directory there, so keeping it.
 DOWNLOAD_PATH = 'data/train-parts'
 
+# gzip compression level for downloaded datasets that arrive uncompressed, i.e.
+# the files extracted from zip archives. Higher levels are a lot slower for
+# files that are only a few percent smaller.
+DOWNLOAD_COMPRESSLEVEL = int(os.getenv('DOWNLOAD_COMPRESSLEVEL', '3'))
+
+# Number of datasets downloaded at the same time. Downloads mostly wait for
+# the network, so this can be more than the number of cores.
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '8'))
+
+# Directory where responses of the OPUS API are kept, and the number of
+# seconds they are used for before asking the API again. The listings of
+# corpora change rarely, and fetching them takes a while.
+OPUSAPI_CACHE_PATH = os.getenv('OPUSAPI_CACHE_PATH', os.path.join(
+	os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+	'opuscleaner', 'opusapi'))
+
+OPUSAPI_CACHE_TTL = int(os.getenv('OPUSAPI_CACHE_TTL', str(6 * 3600)))
+
 # glob expression that looks for the filter files. Unfortunately you can't use
 # commas and {} in this expression.
 FILTER_PATH = os.pathsep.join([
@@ -37,3 +55,7 @@ SAMPLE_PY = [sys.executable, os.path.join(os.path.dirname(__file__), 'sample.py'
 # Size of each of the three sections (head, random sample of middle, tail) of
 # the dataset sample that we operate on.
 SAMPLE_SIZE = int(os.getenv('SAMPLE_SIZE', '1000'))
+
+# Number of samples computed at the same time by `datasets.py sample`. Each one
+# is a sample.py process reading all files of a dataset.
+SAMPLE_CONCURRENCY = int(os.getenv('SAMPLE_CONCURRENCY', str(os.cpu_count() or 4)))
@@ -4,51 +4,166 @@ import asyncio
 import os
 import pprint
 import sys
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import lru_cache
 from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from shutil import copyfileobj
-from tempfile import TemporaryFile
-from typing import Dict, List, Tuple, Iterable
-
-from opuscleaner.config import DATA_PATH, SAMPLE_PY, SAMPLE_SIZE
+from typing import Dict, List, Optional, Set, Tuple, Iterable
+from uuid import uuid4
+
+from opuscleaner.config import DATA_PATH, SAMPLE_PY, SAMPLE_SIZE, SAMPLE_CONCURRENCY
+
+
+# Results of `list_datasets()` by path, together with the modification times
+# of the directories the result was read from.
+_CACHE: Dict[str,Tuple[Dict[str,int],Dict[str,List[Tuple[str,Path]]]]] = {}
+
+# Number of directories listed at the same time when the pattern spans more
+# than one. Listing a directory on a network file system is a round trip to
+# the server, and these can overlap.
+SCAN_THREADS = 8
+
+
+def _scan_dir(dirpath:str, parts:List[str]) -> Tuple[Optional[int],List[str],List[Tuple[str,List[str]]]]:
+    """Lists the files in `dirpath` that match `parts`, a glob pattern split
+    into path components. Returns the modification time of `dirpath` (or None
+    if it doesn't exist), the matching files, and the subdirectories that
+    still need to be scanned together with what remains of the pattern."""
+    files: List[str] = []
+    subdirs: List[Tuple[str,List[str]]] = []
+
+    # `**` matches zero or more directories, so the rest of the pattern
+    # applies to this directory as well.
+    patterns = [parts]
+    while patterns[-1][0] == '**':
+        patterns.append(patterns[-1][1:] or ['*'])
+
+    try:
+        mtime = os.stat(dirpath).st_mtime_ns
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+    except (FileNotFoundError, NotADirectoryError):
+        return None, files, subdirs
+
+    for entry in entries:
+        for pattern in patterns:
+            part, rest = pattern[0], pattern[1:]
+            # Like glob, wildcards don't match hidden files
+            if entry.name.startswith('.') and not part.startswith('.'):
+                continue
+            if part == '**':
+                if entry.is_dir():
+                    subdirs.append((entry.path, pattern))
+            elif fnmatch(entry.name, part):
+                if rest:
+                    if entry.is_dir():
+                        subdirs.append((entry.path, rest))
+                elif entry.is_file():
+                    files.append(entry.path)
+
+    return mtime, files, subdirs
+
+
+def _scan(dirpath:str, parts:List[str], mtimes:Dict[str,int]) -> List[str]:
+    """Returns the paths of the files in `dirpath` that match `parts`, a glob
+    pattern split into path components. Works like `glob(recursive=True)`, but
+    uses `os.scandir()` which for most entries knows whether it is a file or
+    a directory without a `stat()` call. Records the modification time of each
+    directory it reads in `mtimes`: adding, removing or renaming a file changes
+    the modification time of the directory it is in.
+
+    Directories are scanned level by level, and the directories of a level
+    are listed on `SCAN_THREADS` threads at the same time."""
+    files: List[str] = []
+    todo = [(dirpath, parts)]
+    with ThreadPoolExecutor(SCAN_THREADS) as executor:
+        while todo:
+            if len(todo) > 1:
+                results = executor.map(_scan_dir, *zip(*todo))
+            else:
+                results = [_scan_dir(*todo[0])]
+            subdirs: List[Tuple[str,List[str]]] = []
+            for (path, _), (mtime, found, found_subdirs) in zip(todo, results):
+                if mtime is not None:
+                    mtimes[path] = mtime
+                files += found
+                subdirs += found_subdirs
+            todo = subdirs
+    # Patterns with more than one `**` can match a file more than once
+    return list(dict.fromkeys(files))
+
+
+def _unchanged(mtimes:Dict[str,int]) -> bool:
+    try:
+        return all(os.stat(dirpath).st_mtime_ns == mtime for dirpath, mtime in mtimes.items())
+    except OSError:
+        return False
 
 
 def list_datasets(path:str) -> Dict[str,List[Tuple[str,Path]]]:
     """Lists datasets given a directory. Scans the directories and returns a dictionary of the
-    datasets encoutered. Dictionary looks like {dataset_name : { lang: path}}"""
-    root = Path(path.split('*')[0])
+    datasets encoutered. Dictionary looks like {dataset_name : { lang: path}}
 
-    entries = (Path(entry) for entry in glob(path, recursive=True))
+    The result is cached until a file is added to or removed from one of the
+    scanned directories, so treat it as read-only. See also
+    `clear_datasets_cache()`."""
+    cached = _CACHE.get(path)
+    if cached is not None and _unchanged(cached[0]):
+        return cached[1]
 
-    files = [
-        entry
-        for entry in entries
-        if entry.is_file()
-        and entry.name.endswith('.gz')
-        and not entry.name.startswith('.')
-    ]
+    root = Path(path.split('*')[0])
 
-    datasets = [
-        (name, list(files))
-        for name, files in groupby(
-            sorted(files, key=lambda entry: str(entry)),
-            key=lambda entry: str(entry.relative_to(root)).rsplit('.', 2)[0])
+    # Start scanning at the last directory before any wildcards
+    parts = path.split('/')
+    n = next((n for n, part in enumerate(parts) if any(char in part for char in '*?[')), len(parts) - 1)
+    base = '/'.join(parts[:n]) or ('/' if n else os.curdir)
+    mtimes: Dict[str,int] = {}
+    files = [
+        Path(entry)
+        for entry in _scan(base, parts[n:], mtimes)
+        if entry.endswith('.gz')
+        and not os.path.basename(entry).startswith('.')
     ]
 
-    return {
-        name: [
-            (entry.name.rsplit('.', 2)[1], entry)
+    # (dataset, lang, path) for each file, sorted by dataset and then language.
+    # There are only a handful of different languages, so share those strings.
+    triples = sorted(
+        (
+            (str(entry.relative_to(root)).rsplit('.', 2)[0], sys.intern(entry.name.rsplit('.', 2)[1]), entry)
             for entry in files
-        ]
-        for name, files in datasets
+        ),
+        key=itemgetter(0, 1))
+
+    result = {
+        name: [(lang, entry) for _, lang, entry in group]
+        for name, group in groupby(triples, key=itemgetter(0))
     }
 
+    # Only cache if there was something to keep an eye on
+    if mtimes:
+        _CACHE[path] = mtimes, result
+
+    return result
+
 
+def clear_datasets_cache() -> None:
+    """Drops the results cached by `list_datasets()`. Call it after adding
+    datasets: a directory's modification time might only have a resolution
+    of a second, so a change right after a scan can go unnoticed."""
+    _CACHE.clear()
+
+
+# Directory the dataset names are relative to
+_DATA_ROOT = DATA_PATH.split('*')[0]
+
+
+@lru_cache(maxsize=4096)
 def dataset_path(name:str, template:str) -> str:
     # TODO: fix this hack to get the file path from the name this is silly we
     # should just use get_dataset(name).path or something
-    root = DATA_PATH.split('*')[0]
+    root = _DATA_ROOT
 
     # If the dataset name is a subdirectory, do some hacky shit to get to a
     # .sample.gz file in said subdirectory.
@@ -80,39 +195,70 @@ def main_list_commands(args):
     sys.exit(1)
 
 
+def _list_dir(dirpath:str) -> Set[str]:
+    """Names of the entries in `dirpath`, or nothing if it doesn't exist."""
+    try:
+        with os.scandir(dirpath or os.curdir) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
 async def sample_all_datasets(args):
     tasks = []
 
+    # Look up whether samples exist in a listing of their directory, instead of
+    # doing a stat() per sample.
+    listings: Dict[str,Set[str]] = {}
+
     for name, columns in list_datasets(DATA_PATH).items():
         langs = [lang for lang, _ in columns]
-        if not os.path.exists(sample_path(name, langs)) or args.force:
+        dirname, basename = os.path.split(sample_path(name, langs))
+        if dirname not in listings:
+            listings[dirname] = _list_dir(dirname)
+        if basename not in listings[dirname] or args.force:
             print(f"Sampling {name}...", file=sys.stderr)
             tasks.append([name, columns])
 
-    for task, result in zip(tasks, await asyncio.gather(*[compute_sample(*task) for task in tasks], return_exceptions=True)):
+    # Don't start a sample.py for every dataset at once
+    semaphore = asyncio.Semaphore(args.jobs)
+
+    async def limited_compute_sample(name:str, columns:List[Tuple[str,Path]]) -> None:
+        async with semaphore:
+            await compute_sample(name, columns)
+
+    for task, result in zip(tasks, await asyncio.gather(*[limited_compute_sample(*task) for task in tasks], return_exceptions=True)):
         if isinstance(result, Exception):
             print(f"Could not compute sample for {task[0]}: {result!s}", file=sys.stderr)
 
 
 async def compute_sample(name:str, columns:List[Tuple[str,Path]]) -> None:
     langs = [lang for lang, _ in columns]
-    with TemporaryFile() as tempfile:
-        proc = await asyncio.subprocess.create_subprocess_exec(
-            *SAMPLE_PY,
-            '-n', str(SAMPLE_SIZE),
-            *[str(file.resolve()) for _, file in columns],
-            stdout=tempfile,
-            stderr=asyncio.subprocess.PIPE)
+    dest = sample_path(name, langs)
 
-        _, stderr = await proc.communicate()
+    # sample.py writes straight into a temporary file next to the sample, which
+    # replaces the sample only once it is complete. Not a NamedTemporaryFile:
+    # that is only readable by us, and the sample should get the permissions
+    # the umask gives it, like any other file in the data directory.
+    tempname = f'{dest}.{uuid4().hex}.tmp'
+    with open(os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), 'wb') as tempfile:
+        try:
+            proc = await asyncio.subprocess.create_subprocess_exec(
+                *SAMPLE_PY,
+                '-n', str(SAMPLE_SIZE),
+                *[str(file.resolve()) for _, file in columns],
+                stdout=tempfile,
+                stderr=asyncio.subprocess.PIPE)
 
-        if proc.returncode != 0:
-            raise Exception(f'sample.py failed with exit code {proc.returncode}: {stderr.decode()}')
+            _, stderr = await proc.communicate()
 
-        tempfile.seek(0)
+            if proc.returncode != 0:
+                raise Exception(f'sample.py failed with exit code {proc.returncode}: {stderr.decode()}')
+        except:
+            os.unlink(tempname)
+            raise
 
-        with open(sample_path(name, langs), 'wb') as fdest:
-            copyfileobj(tempfile, fdest)
+    os.replace(tempname, dest)
 
 
 def main_list(args):
@@ -136,6 +282,7 @@ def main(argv=sys.argv):
 
     parser_sample = subparsers.add_parser('sample')
     parser_sample.add_argument("--force", "-f", action="store_true")
+    parser_sample.add_argument("--jobs", "-j", type=int, default=SAMPLE_CONCURRENCY, help="Number of samples to compute at the same time (default: %(default)s)")
     parser_sample.set_defaults(func=main_sample)
 
     args = parser.parse_args()
@@ -1,37 +1,50 @@
 #!/usr/bin/env python3
 """Various mtdata dataset downloading utilities"""
 import argparse
+import hashlib
 import os
 import sys
-import asyncio
-import json
-import gzip
+import io
 import logging
 import shutil
-from glob import iglob
-from itertools import chain
-from typing import Iterable, Dict, List, Optional, Set, Union, Tuple, cast, Any
+import struct
+import time
+import zlib
+from http.client import HTTPConnection, HTTPSConnection, HTTPResponse, HTTPException as HTTPClientException, IncompleteRead
+from typing import IO, Callable, Iterable, Iterator, Dict, FrozenSet, List, Optional, Set, Tuple, Union, Any
 from enum import Enum
-from queue import SimpleQueue
-from subprocess import Popen, PIPE
-from threading import Thread
-from collections import defaultdict
-from urllib.request import Request, urlopen
-from urllib.parse import urlencode
-from pprint import pprint
-from operator import itemgetter
-from warnings import warn
-from tempfile import TemporaryDirectory, TemporaryFile, NamedTemporaryFile
-from shutil import copyfileobj
-from multiprocessing import Process
-from zipfile import ZipFile
-from concurrent.futures import ProcessPoolExecutor
+from threading import Event, Lock, local
+from urllib.error import HTTPError
+from urllib.request import Request, getproxies, urlopen
+from urllib.parse import urlencode, urljoin, urlsplit, urlunsplit
+from tempfile import TemporaryDirectory, NamedTemporaryFile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, BadZipFile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Same interface as gzip, but a lot faster at compressing. isal only has
+# levels 0 to 3.
+GZIP_MAX_COMPRESSLEVEL = 9
+try:
+    from zlib_ng import gzip_ng as gzip
+except ImportError:
+    try:
+        from isal import igzip as gzip
+        GZIP_MAX_COMPRESSLEVEL = 3
+    except ImportError:
+        import gzip
+
 from pydantic import BaseModel
 from fastapi import FastAPI, HTTPException
 
-from opuscleaner.config import DATA_PATH, DOWNLOAD_PATH
+from opuscleaner.config import DATA_PATH, DOWNLOAD_PATH, DOWNLOAD_COMPRESSLEVEL, DOWNLOAD_WORKERS, OPUSAPI_CACHE_PATH, OPUSAPI_CACHE_TTL
+from opuscleaner.datasets import clear_datasets_cache
 
 
 class EntryRef(BaseModel):
@@ -51,7 +64,7 @@ class Entry(EntryRef):
 
 
 class LocalEntry(Entry):
-    paths: Set[str]
+    paths: FrozenSet[str]
 
 
 class RemoteEntry(Entry):
@@ -66,76 +79,448 @@ class DownloadState(Enum):
     FAILED = 'failed'
 
 
-def get_dataset(entry:RemoteEntry, path:str) -> None:
+class DownloadCancelled(Exception):
+    """Raised while downloading a dataset once its `cancelled` event is set."""
+    pass
+
+
+def get_dataset(entry:RemoteEntry, path:str, *, cancelled:Optional[Event]=None) -> None:
     if entry.url.endswith('.zip'):
-        get_bilingual_dataset(entry, path)
+        get_bilingual_dataset(entry, path, cancelled=cancelled)
     elif entry.url.endswith('.txt.gz'):
-        get_monolingual_dataset(entry, path)
+        get_monolingual_dataset(entry, path, cancelled=cancelled)
     else:
         raise RuntimeError(f'Unknown dataset file type: {entry.url}')
 
 
-def get_monolingual_dataset(entry:RemoteEntry, path:str) -> None:
+# Block size for copying downloads to disk
+DOWNLOAD_BUFFER_SIZE = 2**22 # 4MB
+
+
+def _copy(fin:IO[bytes], fout:IO[bytes], *, length:int, cancelled:Optional[Event]=None) -> None:
+    """Like `copyfileobj()`, but raises `DownloadCancelled` in between blocks
+    once `cancelled` is set. Reads into the same buffer every time instead of
+    allocating a new `bytes` for each block."""
+    buffer = memoryview(bytearray(length))
+    while not (cancelled and cancelled.is_set()):
+        n = fin.readinto(buffer)
+        if not n:
+            return
+        fout.write(buffer[:n])
+    raise DownloadCancelled()
+
+
+def _download(url:str, fout:IO[bytes], *, cancelled:Optional[Event]=None) -> None:
+    """Writes the file at `url` to `fout`, as is."""
+    # Ask for the file itself: urllib won't undo a Content-Encoding, and our
+    # files are compressed already anyway.
+    with urlopen(Request(url, headers={'Accept-Encoding': 'identity'})) as fh:
+        _copy(fh, fout, length=DOWNLOAD_BUFFER_SIZE, cancelled=cancelled)
+        _check_complete(fh)
+
+
+def _check_complete(fh:IO[bytes]) -> None:
+    """Raises `IncompleteRead` if the connection closed before all of the
+    response was read. `HTTPResponse.readinto()` doesn't, it just returns 0."""
+    remaining = getattr(fh, 'length', None) # not there for file:// urls
+    if remaining:
+        raise IncompleteRead(b'', remaining)
+
+
+# Connections kept open by `_urlopen()` for the next request to the same
+# server. Per thread, since http.client's connections can't be shared.
+_connections = local()
+
+# Redirects `_urlopen()` follows before giving up
+MAX_REDIRECTS = 10
+
+
+def _send(url:str, method:str, headers:Dict[str,str]) -> Tuple[HTTPConnection, HTTPResponse]:
+    """Sends a request over this thread's open connection to the server of
+    `url`, or a new one if there is none. A kept connection may have been
+    closed by the server in the meantime, in which case we try again once
+    with a fresh one."""
+    pool: Dict[Tuple[str,str],HTTPConnection] = _connections.__dict__.setdefault('pool', {})
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    target = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    while True:
+        connection = pool.pop(key, None)
+        reused = connection is not None
+        if connection is None:
+            connection = (HTTPSConnection if parts.scheme == 'https' else HTTPConnection)(parts.netloc)
+        try:
+            connection.request(method, target, headers=headers)
+            response = connection.getresponse()
+        except (ConnectionError, HTTPClientException):
+            connection.close()
+            if reused:
+                continue
+            raise
+        pool[key] = connection
+        return connection, response
+
+
+@contextmanager
+def _urlopen(url:str, *, method:str='GET', headers:Dict[str,str]={}) -> Iterator[HTTPResponse]:
+    """Like `urlopen()`, but reuses the connection of an earlier request to
+    the same server on this thread. Saves setting up a TCP connection and TLS
+    session for every request, which adds up for the many range requests
+    `HTTPRangeReader` makes. Follows redirects and raises `HTTPError` like
+    `urlopen()` does. Anything but http(s) without a proxy goes through
+    `urlopen()` itself."""
+    for _ in range(MAX_REDIRECTS):
+        scheme = urlsplit(url).scheme
+        if scheme not in ('http', 'https') or scheme in getproxies():
+            with urlopen(Request(url, method=method, headers=headers)) as fh:
+                yield fh
+            return
+
+        connection, response = _send(url, method, headers)
+        response.url = url # for geturl()
+        try:
+            if response.status in (301, 302, 303, 307, 308) and 'Location' in response.headers:
+                response.read()
+                url = urljoin(url, response.headers['Location'])
+                if response.status == 303:
+                    method = 'GET'
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            yield response
+            return
+        finally:
+            # The connection can only be used again once the response has been
+            # read in full.
+            if not response.isclosed() or response.will_close:
+                response.close()
+                connection.close()
+    raise HTTPError(url, 310, 'Too many redirects', {}, None)
+
+
+# Attempts at downloading a file before giving up, and the seconds to wait
+# before the first retry. The wait doubles with each retry.
+DOWNLOAD_ATTEMPTS = 4
+DOWNLOAD_RETRY_DELAY = 1.0
+
+
+def _download_resumable(url:str, dest:str, *, cancelled:Optional[Event]=None) -> None:
+    """Downloads the file at `url` to `dest`. The data goes to `dest.part`
+    first, which is kept when the download fails halfway. The next attempt,
+    right away after a network error or on a later call, continues where
+    that one stopped if the server supports range requests and the file on
+    the server is still the same one. Otherwise it starts over."""
+    part_path = f'{dest}.part'
+    validator_path = f'{dest}.part.validator'
+
+    def discard() -> None:
+        for leftover in (part_path, validator_path):
+            Path(leftover).unlink(missing_ok=True)
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        last_attempt = attempt + 1 == DOWNLOAD_ATTEMPTS
+        headers = {'Accept-Encoding': 'identity'}
+        try:
+            offset = os.path.getsize(part_path)
+            with open(validator_path) as fh:
+                validator = fh.read()
+        except FileNotFoundError:
+            offset, validator = 0, ''
+        if offset and validator:
+            # If-Range: if the file changed since, we get all of it instead.
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+
+        try:
+            with urlopen(Request(url, headers=headers)) as fh:
+                if fh.status != 206:
+                    # Starting from the beginning. Remember what version of
+                    # the file this is, in case we have to continue later.
+                    offset = 0
+                    with open(validator_path, 'w') as fout:
+                        fout.write(fh.headers.get('ETag') or fh.headers.get('Last-Modified') or '')
+                with open(part_path, 'ab' if offset else 'wb') as fout:
+                    _copy(fh, fout, length=DOWNLOAD_BUFFER_SIZE, cancelled=cancelled)
+                _check_complete(fh)
+            break
+        except DownloadCancelled:
+            discard()
+            raise
+        except HTTPError as e:
+            if e.code == 416: # Range not satisfiable: start over
+                discard()
+                if last_attempt:
+                    raise
+                continue
+            if e.code < 500 or last_attempt:
+                raise
+            LOG.warning(f'Download of {url} failed, retrying: {e}')
+        except (OSError, HTTPClientException) as e:
+            if last_attempt:
+                raise
+            LOG.warning(f'Download of {url} failed, retrying: {e}')
+        time.sleep(DOWNLOAD_RETRY_DELAY * 2**attempt)
+    else:
+        # Every failed last attempt raises, so we only get here by mistake.
+        raise RuntimeError(f'Download of {url} failed')
+
+    os.replace(part_path, dest)
+    os.remove(validator_path)
+
+
+class HTTPRangeReader(io.RawIOBase):
+    """Seekable, read-only file at an http(s) url. Each read fetches just the
+    bytes asked for with a Range request. Wrap it in a BufferedReader so small
+    reads don't each turn into a request.
+
+    The end of the file is fetched once and kept: that's where a zip archive
+    keeps its central directory, which ZipFile reads in a couple of small
+    reads at different offsets."""
+    url: str
+    size: int
+    pos: int
+
+    # Last `TAIL_SIZE` bytes of the file, once read
+    _tail: Optional[bytes]
+
+    # Enough for the end of central directory record of a zip archive with the
+    # longest possible comment, and the central directory of small archives.
+    TAIL_SIZE = 2**16 + 22
+
+    def __init__(self, url:str, size:int):
+        self.url = url
+        self.size = size
+        self.pos = 0
+        self._tail = None
+
+    @classmethod
+    def open(cls, url:str) -> Optional['HTTPRangeReader']:
+        """Returns a reader for `url`, or None if the server at `url` does
+        not support range requests, or refuses to answer a HEAD request."""
+        if not url.startswith(('http://', 'https://')):
+            return None
+
+        try:
+            with _urlopen(url, method='HEAD', headers={'Accept-Encoding': 'identity'}) as fh:
+                if fh.headers.get('Accept-Ranges') != 'bytes' or fh.headers.get('Content-Length') is None:
+                    return None
+                return cls(fh.geturl(), int(fh.headers['Content-Length']))
+        except HTTPError: # e.g. 405, or 403 for a signed URL that's only valid for GET
+            return None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self.pos = offset
+        return self.pos
+
+    def _fetch(self, start:int, view:memoryview) -> int:
+        """Reads the bytes starting at `start` into `view`."""
+        headers = {
+            'Range': f'bytes={start}-{start + len(view) - 1}',
+            'Accept-Encoding': 'identity'
+        }
+        with _urlopen(self.url, headers=headers) as fh:
+            # A server may answer a request for the whole file with the whole
+            # file, otherwise it has to be the part we asked for.
+            if fh.status != 206 and not (fh.status == 200 and start == 0):
+                raise OSError(f'Server did not honour range request for {self.url}')
+            n = 0
+            while n < len(view):
+                read = fh.readinto(view[n:])
+                if not read:
+                    break
+                n += read
+        return n
+
+    def readinto(self, buffer) -> int:
+        end = min(self.pos + len(buffer), self.size)
+        if end <= self.pos:
+            return 0
+
+        view = memoryview(buffer)[:end - self.pos]
+
+        tail_start = max(self.size - self.TAIL_SIZE, 0)
+        if self.pos >= tail_start:
+            if self._tail is None:
+                tail = bytearray(self.size - tail_start)
+                del tail[self._fetch(tail_start, memoryview(tail)):]
+                self._tail = bytes(tail)
+            chunk = self._tail[self.pos - tail_start:self.pos - tail_start + len(view)]
+            n = len(chunk)
+            view[:n] = chunk
+        else:
+            n = self._fetch(self.pos, view)
+
+        self.pos += n
+        return n
+
+
+# Smallest range to request when reading an archive over http
+RANGE_READ_SIZE = 2**20 # 1MB
+
+
+@contextmanager
+def _open_archive(url:str, *, cancelled:Optional[Event]=None) -> Iterator[Callable[[], IO[bytes]]]:
+    """Makes the archive at `url` available for reading. If the server
+    supports range requests, only the parts that are read are downloaded: for
+    a zip archive that's the central directory and the members we extract.
+    Otherwise the whole archive is downloaded to a temporary file first.
+    Yields a function that opens the archive. Each file it returns has its
+    own read position, so threads can each read their own part."""
+    reader = HTTPRangeReader.open(url)
+    if reader is not None:
+        yield lambda: io.BufferedReader(HTTPRangeReader(reader.url, reader.size), RANGE_READ_SIZE)
+    else:
+        with NamedTemporaryFile() as fh:
+            _download(url, fh, cancelled=cancelled)
+            fh.flush()
+            yield lambda: open(fh.name, 'rb')
+
+
+def get_monolingual_dataset(entry:RemoteEntry, path:str, *, cancelled:Optional[Event]=None) -> None:
     lang = next(lang for lang in entry.langs if lang != '')
     assert entry.url.endswith(f'{lang}.txt.gz')
     
     # Make sure our path exists
     os.makedirs(path, exist_ok=True)
 
-    with TemporaryDirectory(dir=path) as temp_dir:
-        temp_path = os.path.join(temp_dir, os.path.basename(entry.url))
-        dest_path = os.path.join(path, f'{entry.basename}.{lang}.gz')
+    dest_path = os.path.join(path, f'{entry.basename}.{lang}.gz')
+
+    # Downloads to a temporary file first, and moves it into place when done
+    _download_resumable(entry.url, dest_path, cancelled=cancelled)
 
-        # Download dataset to temporary file
-        with urlopen(entry.url) as fh, open(temp_path, 'wb') as fout:
-            copyfileobj(fh, fout)
 
-        # move to permanent position
-        os.rename(temp_path, dest_path)
+def _extract(archive:ZipFile, info:ZipInfo, dest:str, *, cancelled:Optional[Event]=None) -> str:
+    with archive.open(info) as fin, gzip.open(dest, 'wb', compresslevel=min(DOWNLOAD_COMPRESSLEVEL, GZIP_MAX_COMPRESSLEVEL)) as fout:
+        _copy(fin, fout, length=2**24, cancelled=cancelled) # 16MB blocks
+    return dest
 
 
-def _extract(path:str, name:str, dest:str) -> str:
-    with ZipFile(path) as archive, archive.open(name) as fin, gzip.open(dest, 'wb') as fout:
-        copyfileobj(fin, fout, length=2**24) # 16MB blocks
+# gzip member header: deflate, no flags, no mtime, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def _can_copy_deflated(info:ZipInfo) -> bool:
+    """Whether `_copy_deflated()` can handle zip member `info`"""
+    return info.compress_type == ZIP_DEFLATED and not info.flag_bits & 0x1 # not encrypted
+
+
+def _can_copy_stored(info:ZipInfo) -> bool:
+    """Whether `_copy_stored()` can handle zip member `info`"""
+    return info.compress_type == ZIP_STORED and not info.flag_bits & 0x1 # not encrypted
+
+
+def _seek_member_data(fin:IO[bytes], info:ZipInfo) -> None:
+    """Moves `fin` to the start of the data of zip member `info`, past its
+    local header."""
+    fin.seek(info.header_offset)
+    header = fin.read(30)
+    if header[:4] != b'PK\x03\x04':
+        raise BadZipFile(f'Bad local file header for {info.filename}')
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    fin.seek(info.header_offset + 30 + name_length + extra_length)
+
+
+def _copy_stored(open_archive:Callable[[], IO[bytes]], info:ZipInfo, dest:str, *, cancelled:Optional[Event]=None) -> str:
+    """Writes the stored (uncompressed) zip member `info` to `dest` as a gzip
+    file. Like `_extract()`, but reads the member from its own file instead
+    of through the ZipFile, whose file all threads have to take turns with."""
+    with open_archive() as fin, gzip.open(dest, 'wb', compresslevel=min(DOWNLOAD_COMPRESSLEVEL, GZIP_MAX_COMPRESSLEVEL)) as fout:
+        _seek_member_data(fin, info)
+        buffer = memoryview(bytearray(2**24)) # 16MB blocks
+        crc = 0
+        remaining = info.file_size
+        while remaining > 0:
+            if cancelled and cancelled.is_set():
+                raise DownloadCancelled()
+            n = fin.readinto(buffer[:min(remaining, len(buffer))])
+            if not n:
+                raise BadZipFile(f'Unexpected end of data for {info.filename}')
+            crc = zlib.crc32(buffer[:n], crc)
+            fout.write(buffer[:n])
+            remaining -= n
+        if crc != info.CRC:
+            raise BadZipFile(f'Bad CRC-32 for file {info.filename}')
     return dest
 
 
-def get_bilingual_dataset(entry:RemoteEntry, path:str) -> None:
-    # List of extensions of the expected files, e.g. `.en-mt.mt` and `.en-mt.en`.
-    suffixes = [f'.{"-".join(entry.langs)}.{lang}' for lang in entry.langs]
+def _copy_deflated(open_archive:Callable[[], IO[bytes]], info:ZipInfo, dest:str, *, cancelled:Optional[Event]=None) -> str:
+    """Writes the deflated zip member `info` to `dest` as a gzip file by
+    putting its compressed data as is between a gzip header and trailer.
+    Both formats use the same raw deflate stream, so there's no need to
+    decompress and compress it again. The CRC-32 in the trailer comes from the
+    zip archive, so gunzip will still check it."""
+    with open_archive() as fin, open(dest, 'wb') as fout:
+        _seek_member_data(fin, info)
+
+        fout.write(GZIP_HEADER)
+        remaining = info.compress_size
+        while remaining > 0:
+            if cancelled and cancelled.is_set():
+                raise DownloadCancelled()
+            block = fin.read(min(remaining, 2**24)) # 16MB blocks
+            if not block:
+                raise BadZipFile(f'Unexpected end of data for {info.filename}')
+            fout.write(block)
+            remaining -= len(block)
+        fout.write(struct.pack('<II', info.CRC, info.file_size & 0xffffffff))
+    return dest
+
+
+def get_bilingual_dataset(entry:RemoteEntry, path:str, *, cancelled:Optional[Event]=None) -> None:
+    # Extensions of the expected files, e.g. `.en-mt.mt` and `.en-mt.en`. A
+    # tuple, so `str.endswith()` can check all of them in one call.
+    suffixes = tuple(f'.{"-".join(entry.langs)}.{lang}' for lang in entry.langs)
 
     # Make sure our path exists
     os.makedirs(path, exist_ok=True)
 
-    with NamedTemporaryFile() as temp_archive:
-        # Download zip file to temporary file
-        with urlopen(entry.url) as fh:
-            copyfileobj(fh, temp_archive)
-
+    with _open_archive(entry.url, cancelled=cancelled) as open_archive:
         # Then selectively extract that zipfile to a temporary directory
         with TemporaryDirectory(dir=path) as temp_extracted:
             files = []
 
-            with ProcessPoolExecutor(max_workers=8) as pool:
+            # Threads can all read from the same open ZipFile, and spend most of
+            # their time in zlib which doesn't hold on to the GIL.
+            with open_archive() as archive_file, ZipFile(archive_file) as archive, ThreadPoolExecutor(max_workers=8) as pool:
                 futures = []
 
-                with ZipFile(temp_archive) as archive:
-                    for info in archive.filelist:
-                        if info.is_dir() or not any(info.filename.endswith(suffix) for suffix in suffixes):
-                            continue
+                for info in archive.filelist:
+                    if info.is_dir() or not info.filename.endswith(suffixes):
+                        continue
 
-                        # `info.filename` is something like "beepboop.en-nl.en", `lang` will be "en".
-                        _, lang = info.filename.rsplit('.', maxsplit=1)
+                    # `info.filename` is something like "beepboop.en-nl.en", `lang` will be "en".
+                    _, lang = info.filename.rsplit('.', maxsplit=1)
 
-                        filename = f'{entry.basename}.{lang}.gz'
-                        temp_dest = os.path.join(temp_extracted, filename)
-                        data_dest = os.path.join(path, filename)
+                    filename = f'{entry.basename}.{lang}.gz'
+                    temp_dest = os.path.join(temp_extracted, filename)
+                    data_dest = os.path.join(path, filename)
 
-                        # Extract the file from the zip archive into the temporary directory, and
-                        # compress it while we're at it.
-                        future = pool.submit(_extract, temp_archive.name, info.filename, temp_dest)
+                    # Extract the file from the zip archive into the temporary directory, and
+                    # compress it while we're at it. Or if it is compressed already, take
+                    # the compressed data.
+                    if _can_copy_deflated(info):
+                        future = pool.submit(_copy_deflated, open_archive, info, temp_dest, cancelled=cancelled)
+                    elif _can_copy_stored(info):
+                        future = pool.submit(_copy_stored, open_archive, info, temp_dest, cancelled=cancelled)
+                    else:
+                        future = pool.submit(_extract, archive, info, temp_dest, cancelled=cancelled)
 
-                        futures.append((future, data_dest))
+                    futures.append((future, data_dest))
 
                 # Keep a list of extracted files, and where they eventually need to go to
                 for future, data_dest in futures:
@@ -147,65 +532,72 @@ def get_bilingual_dataset(entry:RemoteEntry, path:str) -> None:
 
 
 class EntryDownload:
+    """Download of a single entry. Runs on the thread that calls `run()`,
+    which is one of the `Downloader`'s worker threads. Downloading is waiting
+    for the network and the disk, or zlib, which all let go of the GIL. No
+    need to start a separate process for it."""
     entry: RemoteEntry
-    _child: Optional[Process]
+    _state: DownloadState
+    _cancelled: Event
 
     def __init__(self, entry:RemoteEntry):
         self.entry = entry
-        self._child = None
-    
-    def start(self) -> None:
-        self._child = Process(target=get_dataset, args=(self.entry, DOWNLOAD_PATH))
-        self._child.start()
+        self._state = DownloadState.PENDING
+        self._cancelled = Event()
 
     def run(self) -> None:
-        self.start()
-        assert self._child is not None
-        self._child.join()
+        if self._cancelled.is_set():
+            return
+
+        self._state = DownloadState.DOWNLOADING
+        try:
+            get_dataset(self.entry, DOWNLOAD_PATH, cancelled=self._cancelled)
+        except DownloadCancelled:
+            self._state = DownloadState.CANCELLED
+        except Exception:
+            LOG.exception(f'Download of {self.entry.basename} failed')
+            self._state = DownloadState.FAILED
+        else:
+            # Make the new files show up in the list of datasets right away
+            clear_datasets_cache()
+            self._state = DownloadState.DOWNLOADED
 
     def cancel(self) -> None:
-        if self._child and self._child.exitcode is None:
-            self._child.kill()
+        """Stops the download. If it already started, it stops after the block
+        it is copying right now."""
+        self._cancelled.set()
+        if self._state == DownloadState.PENDING:
+            self._state = DownloadState.CANCELLED
 
     @property
     def state(self) -> DownloadState:
-        if not self._child:
-            return DownloadState.PENDING
-        elif self._child.exitcode is None:
-            return DownloadState.DOWNLOADING
-        elif self._child.exitcode == 0:
-            return DownloadState.DOWNLOADED
-        elif self._child.exitcode > 0:
-            return DownloadState.FAILED
-        else:
-            return DownloadState.CANCELLED
-
-
-DownloadQueue = SimpleQueue#[Optional[EntryDownload]]
+        return self._state
 
 
 class Downloader:
-    def __init__(self, workers:int):
-        self.queue: DownloadQueue = SimpleQueue()
-        self.threads: List[Thread] = []
+    """Runs downloads on a pool of `workers` threads, in the order they were
+    added."""
+    pool: ThreadPoolExecutor
+    _downloads: Set[EntryDownload]
 
-        for _ in range(workers):
-            thread = Thread(target=self.__class__.worker_thread, args=[self.queue], daemon=True)
-            thread.start()
-            self.threads.append(thread)
+    def __init__(self, workers:int):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+        self._downloads = set()
 
     def download(self, entry:RemoteEntry) -> EntryDownload:
         download = EntryDownload(entry=entry)
-        self.queue.put(download)
+        self._downloads.add(download)
+        future = self.pool.submit(download.run)
+        future.add_done_callback(lambda _: self._downloads.discard(download))
         return download
 
-    @staticmethod
-    def worker_thread(queue:DownloadQueue) -> None:
-        while True:
-            entry = queue.get()
-            if not entry:
-                break
-            entry.run()
+    def shutdown(self) -> None:
+        """Cancels all downloads that haven't finished. Ones that are running
+        stop after the block they're copying, so this doesn't keep the process
+        from exiting for long."""
+        for download in list(self._downloads):
+            download.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
 
 class EntryDownloadView(BaseModel):
@@ -222,14 +614,42 @@ class OpusAPI:
         self.endpoint = endpoint
         self._datasets = {}
 
+    def _get(self, query:Dict[str,str]) -> Dict[str,Any]:
+        """Response of the API to `query`. Responses are kept on disk in
+        `OPUSAPI_CACHE_PATH` and reused for `OPUSAPI_CACHE_TTL` seconds."""
+        url = f'{self.endpoint}?{urlencode(query)}'
+        cache_path = os.path.join(OPUSAPI_CACHE_PATH, f'{hashlib.sha1(url.encode()).hexdigest()}.json')
+
+        try:
+            if time.time() - os.path.getmtime(cache_path) < OPUSAPI_CACHE_TTL:
+                with open(cache_path, 'rb') as fh:
+                    return json_loads(fh.read())
+        except (OSError, ValueError):
+            pass # Not cached, or not readable. Ask the API instead.
+
+        with _urlopen(url) as fh:
+            data = fh.read()
+        response = json_loads(data)
+
+        # Write to a temporary file first so a concurrent reader never sees
+        # half a response.
+        try:
+            os.makedirs(OPUSAPI_CACHE_PATH, exist_ok=True)
+            with NamedTemporaryFile(dir=OPUSAPI_CACHE_PATH, suffix='.tmp', delete=False) as fout:
+                fout.write(data)
+            os.replace(fout.name, cache_path)
+        except OSError as e:
+            LOG.warning(f'Could not cache OPUS API response: {e}')
+
+        return response
+
     def languages(self, lang1: Optional[str] = None) -> List[str]:
         query = {'languages': 'True'}
 
         if lang1 is not None:
             query['source'] = lang1
 
-        with urlopen(f'{self.endpoint}?{urlencode(query)}') as fh:
-            return [str(lang) for lang in json.load(fh).get('languages', [])]
+        return [str(lang) for lang in self._get(query).get('languages', [])]
 
     def get_dataset(self, id:int) -> Entry:
         return self._datasets[id]
@@ -247,8 +667,11 @@ class OpusAPI:
                 'preprocessing': 'moses'
             }
 
-        with urlopen(f'{self.endpoint}?{urlencode(query)}') as fh:
-            datasets = [cast_entry(entry) for entry in json.load(fh).get('corpora', [])]
+        # The response comes from the cache in `_get()` most of the time. Only
+        # the entries are made again, because whether we have a local copy of
+        # a corpus changes more often than the listing does.
+        local_files = list_local_files()
+        datasets = [cast_entry(entry, local_files) for entry in self._get(query).get('corpora', [])]
 
         # FIXME dirty hack to keep a local copy to be able to do id based lookup
         # Related: https://github.com/Helsinki-NLP/OPUS-API/issues/3
@@ -264,25 +687,48 @@ api = OpusAPI('https://opus.nlpl.eu/opusapi/')
 
 downloads: Dict[int,EntryDownload] = {}
 
-downloader = Downloader(2)
+# FastAPI runs the endpoints on a thread pool. Taken while checking whether
+# a dataset is being downloaded already and adding it to `downloads`, so two
+# requests at the same time can't both start downloading the same dataset.
+downloads_lock = Lock()
+
+downloader = Downloader(DOWNLOAD_WORKERS)
 
 datasets_by_id: Dict[int, Entry] = {}
 
-def cast_entry(data:Dict[str,Any]) -> Entry:
+def list_local_files() -> Dict[str,Set[str]]:
+    """Names of the files in each of the directories datasets can be in."""
+    files: Dict[str,Set[str]] = {}
+    for data_root in dict.fromkeys([os.path.dirname(DATA_PATH), DOWNLOAD_PATH]):
+        try:
+            with os.scandir(data_root) as entries:
+                files[data_root] = {entry.name for entry in entries}
+        except FileNotFoundError:
+            files[data_root] = set()
+    return files
+
+
+def cast_entry(data:Dict[str,Any], local_files:Optional[Dict[str,Set[str]]]=None) -> Entry:
+    # The API repeats the same few corpus names, versions and languages over
+    # and over. Interning them keeps one copy of each in memory.
     entry = Entry(
         id=int(data['id']),
-        corpus=str(data['corpus']),
-        version=str(data['version']),
+        corpus=sys.intern(str(data['corpus'])),
+        version=sys.intern(str(data['version'])),
         pairs=int(data['alignment_pairs']) if data.get('alignment_pairs') != '' else None,
         size=int(data['size']) * 1024, # FIXME file size but do we care?
-        langs=(data['source'], data['target']), # FIXME these are messy OPUS-API lang codes :(
+        langs=(sys.intern(str(data['source'])), sys.intern(str(data['target']))), # FIXME these are messy OPUS-API lang codes :(
     )
 
-    paths = set(
-        filename
-        for data_root in [os.path.dirname(DATA_PATH), DOWNLOAD_PATH]
+    if local_files is None:
+        local_files = list_local_files()
+
+    paths = frozenset(
+        os.path.join(data_root, filename)
+        for data_root, filenames in local_files.items()
         for lang in entry.langs
-        for filename in iglob(os.path.join(data_root, f'{entry.basename}.{lang}.gz'), recursive=True)
+        for filename in [f'{entry.basename}.{lang}.gz']
+        if filename in filenames
     )
 
     # Print search paths
@@ -321,33 +767,34 @@ def list_downloads() -> Iterable[EntryDownloadView]:
             entry = download.entry,
             state = download.state
         )
-        for download in downloads.values()
+        for download in list(downloads.values())
     )
 
 
 @app.post('/downloads/')
 def batch_add_downloads(datasets: List[EntryRef]) -> Iterable[EntryDownloadView]:
     """Batch download requests!"""
-    needles = set(dataset.id
-        for dataset in datasets
-        if dataset.id not in downloads
-        or downloads[dataset.id].state in {DownloadState.CANCELLED, DownloadState.FAILED})
+    with downloads_lock:
+        needles = set(dataset.id
+            for dataset in datasets
+            if dataset.id not in downloads
+            or downloads[dataset.id].state in {DownloadState.CANCELLED, DownloadState.FAILED})
 
-    entries = [
-        api.get_dataset(id) for id in needles
-    ]
+        entries = [
+            api.get_dataset(id) for id in needles
+        ]
 
-    for entry in entries:
-        assert isinstance(entry, RemoteEntry)
-        downloads[entry.id] = downloader.download(entry)
+        for entry in entries:
+            assert isinstance(entry, RemoteEntry)
+            downloads[entry.id] = downloader.download(entry)
 
     return list_downloads()
 
 
 @app.delete('/downloads/{dataset_id}')
 def cancel_download(dataset_id:int) -> EntryDownloadView:
-    """Cancel a download. Removes it from the queue, does not kill the process
-    if download is already happening.
+    """Cancel a download. Removes it from the queue, or stops it if it is
+    already happening.
     """
     if dataset_id not in downloads:
         raise HTTPException(status_code=404, detail='Download not found')
@@ -361,6 +808,24 @@ def cancel_download(dataset_id:int) -> EntryDownloadView:
     )
     
 LOG = logging.getLogger("download")
+
+
+# Directories that won't have any datasets in them
+SKIP_DIRS = frozenset({'node_modules', '__pycache__'})
+
+
+def find_files(root:Union[str,Path], name:str) -> Iterator[str]:
+    """Yields the paths of all files called `name` below `root`. Hidden
+    directories (like .git) and those in `SKIP_DIRS` are not searched."""
+    todo = [str(root)]
+    while todo:
+        with os.scandir(todo.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.') and entry.name not in SKIP_DIRS:
+                        todo.append(entry.path)
+                elif entry.name == name and entry.is_file():
+                    yield entry.path
   
 def main():
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(name)s:  %(message)s', \
@@ -377,7 +842,7 @@ def main():
         root_dir = Path(root_dir)
         
     LOG.info(f"Searching for categories.json in {root_dir}")
-    cat_files = [Path(dirpath,f) for dirpath,_,files in os.walk(root_dir) for f in files if Path(f).name == "categories.json"]
+    cat_files = [Path(path) for path in find_files(root_dir, "categories.json")]
     LOG.info(f"Found {len(cat_files)} categories.json files")
     
     entry_cache = {} # caches basename -> entry
@@ -385,7 +850,8 @@ def main():
     for cat_file in cat_files:
         target_dir = cat_file.parent
         LOG.debug(f"Processing corpora in {cat_file}")
-        cat_data = json.load(open(cat_file))
+        with open(cat_file, 'rb') as fh:
+            cat_data = json_loads(fh.read())
         for cat_list in cat_data['mapping'].values():
             for corpus_id in cat_list:
                 entry = entry_cache.get(corpus_id)
@@ -1,16 +1,21 @@
-import json
 import os
 import re
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from enum import Enum
 from glob import glob
 from shlex import quote
-from typing import Optional, Iterable, Union, Literal, Any, List, Dict, Iterator
+from typing import Optional, Iterable, Union, Literal, Any, List, Dict, FrozenSet, Iterator
 from warnings import warn
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 import yaml
-from pydantic import BaseModel, parse_obj_as, validator
+from pydantic import BaseModel, PrivateAttr, parse_obj_as, validator
 
 from opuscleaner.config import COL_PY
 from opuscleaner._util import none_throws
@@ -129,6 +134,17 @@ class Filter(BaseModel):
     basedir: str
     parameters: Dict[str,FilterParameter]
 
+    # Names of `parameters`, computed once for FilterStep's validators.
+    _parameter_keys: FrozenSet[str] = PrivateAttr(default_factory=frozenset)
+
+    # Whether `command` takes its parameters as YAML, see filter_format_parameters()
+    _parameters_as_yaml: bool = PrivateAttr(default=False)
+
+    def __init__(self, **data: Any):
+        super().__init__(**data)
+        self._parameter_keys = frozenset(self.parameters.keys())
+        self._parameters_as_yaml = 'PARAMETERS_AS_YAML' in self.command
+
     @validator('parameters')
     def check_keys(cls, parameters: Dict[str,Any]) -> Dict[str,Any]:
         for var_name in parameters.keys():
@@ -139,6 +155,10 @@ class Filter(BaseModel):
 
 _FILTERS: Dict[str,Filter] = {}
 
+# libyaml's dumper if PyYAML was built with it. Same output as safe_dump(),
+# but written in C.
+YAMLDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class FilterStep(BaseModel):
     filter: str
@@ -156,8 +176,9 @@ class FilterStep(BaseModel):
     def check_parameters(cls, parameters:Dict[str,Any], values:Dict[str,Any], **kwargs) -> Dict[str,Any]:
         global _FILTERS
         if _FILTERS and 'filter' in values:
-            required = set(_FILTERS[values['filter']].parameters.keys())
-            provided = set(parameters.keys())
+            filter_definition = _FILTERS[values['filter']]
+            required = filter_definition._parameter_keys
+            provided = parameters.keys()
 
             missing_keys = required - provided
             if missing_keys:
@@ -165,7 +186,7 @@ class FilterStep(BaseModel):
                 # Just add their default values in that case.
                 parameters |= {
                     key: parameter.default if hasattr(parameter, 'default') and parameter.default is not None else parameter.default_factory()
-                    for key, parameter in _FILTERS[values['filter']].parameters.items()
+                    for key, parameter in filter_definition.parameters.items()
                     if key in missing_keys
                 }
             
@@ -181,9 +202,10 @@ class FilterStep(BaseModel):
     @validator('language', always=True)
     def check_language_is_provided(cls, language:str, values:Dict[str,Any], **kwargs) -> str:
         if _FILTERS and 'filter' in values:
-            if _FILTERS[values['filter']].type == FilterType.BILINGUAL and language is not None:
+            filter_type = _FILTERS[values['filter']].type
+            if filter_type == FilterType.BILINGUAL and language is not None:
                 raise ValueError('Cannot `language` attribute for a bilingual filter')
-            elif _FILTERS[values['filter']].type == FilterType.MONOLINGUAL and language is None:
+            elif filter_type == FilterType.MONOLINGUAL and language is None:
                 raise ValueError('`language` attribute required for a monolingual filter')
         return language
 
@@ -194,16 +216,34 @@ class FilterPipeline(BaseModel):
     filters: List[FilterStep]
 
 
+# Number of filter definitions read and parsed at the same time
+LOAD_THREADS = 16
+
+
+def _load_filter(filename:str) -> Filter:
+    with open(filename, 'rb') as fh:
+        data = json_loads(fh.read())
+    defaults = {
+        "name": os.path.splitext(os.path.basename(filename))[0],
+        "basedir": os.path.dirname(filename)
+    }
+    return parse_obj_as(Filter, {**defaults, **data})
+
+
 def list_filters(paths:str) -> Iterable[Filter]:
-    for path in paths.split(os.pathsep):
-        for filename in glob(path, recursive=True):
+    """Filter definitions in the files matching the glob patterns in `paths`,
+    in the order of the patterns. The files are read on `LOAD_THREADS`
+    threads, which helps mostly when they're on a network drive."""
+    filenames = [
+        filename
+        for path in paths.split(os.pathsep)
+        for filename in glob(path, recursive=True)
+    ]
+    with ThreadPoolExecutor(LOAD_THREADS) as executor:
+        futures = [executor.submit(_load_filter, filename) for filename in filenames]
+        for filename, future in zip(filenames, futures):
             try:
-                with open(filename) as fh:
-                    defaults = {
-                        "name": os.path.splitext(os.path.basename(filename))[0],
-                        "basedir": os.path.dirname(filename)
-                    }
-                    yield parse_obj_as(Filter, {**defaults, **json.load(fh)})
+                yield future.result()
             except Exception as e:
                 warn(f"Could not parse {filename}: {e}")
 
@@ -233,7 +273,28 @@ def format_shell(val: Any) -> str:
         return str(val)
 
 
-def filter_format_command(filter_definition:Filter, filter_step:FilterStep, langs:List[str], *, path_to_col:List[str]=COL_PY) -> str:
+def filter_format_parameters(filter_definition:Filter, filter_step:FilterStep) -> Dict[str,str]:
+    """Variables the command of `filter_definition` expects to find the
+    parameters of `filter_step` in."""
+    if not filter_definition.parameters:
+        return {}
+
+    params = {
+        name: props.export(filter_step.parameters[name])
+        for name, props in filter_definition.parameters.items()
+    }
+
+    if filter_definition._parameters_as_yaml:
+        return {'PARAMETERS_AS_YAML': yaml.dump(params, Dumper=YAMLDumper)}
+    else:
+        return {k: format_shell(v) for k, v in params.items()}
+
+
+def filter_format_command(filter_definition:Filter, filter_step:FilterStep, langs:List[str], *, path_to_col:List[str]=COL_PY, with_parameters:bool=True) -> str:
+    """Shell command for `filter_step`. The parameters are assigned to shell
+    variables in front of it, see `filter_format_parameters()`. With
+    `with_parameters` set to False they are left out, and the caller has to
+    fill them in some other way."""
     if filter_definition.type == FilterType.BILINGUAL:
         command = filter_definition.command
     elif filter_definition.type == FilterType.MONOLINGUAL:
@@ -242,15 +303,10 @@ def filter_format_command(filter_definition:Filter, filter_step:FilterStep, lang
     else:
         raise NotImplementedError()
 
-    if filter_definition.parameters:
-        params = {
-            name: props.export(filter_step.parameters[name])
-            for name, props in filter_definition.parameters.items()
-        }
-        if 'PARAMETERS_AS_YAML' in command:
-            command = f'PARAMETERS_AS_YAML={quote(yaml.safe_dump(params))}; {command}'
-        else:
-            vars_setter = '; '.join(f"{k}={quote(format_shell(v))}" for k, v in params.items())
-            command = f'{vars_setter}; {command}'
+    if with_parameters and filter_definition.parameters:
+        vars_setter = '; '.join(
+            f"{k}={quote(v)}"
+            for k, v in filter_format_parameters(filter_definition, filter_step).items())
+        command = f'{vars_setter}; {command}'
 
     return command
@@ -2,9 +2,8 @@
 from sys import stdin, stdout, stderr
 from typing import Optional
 import argparse
-import re
 import unicodedata
-from clean_common import CHARS
+from clean_common import CHARS, char_re
 
 def parse_user_args():
     """Parse the arguments necessary for this filter"""
@@ -22,6 +21,8 @@ def clean_parallel(src_lang: str, ratio_words_src: float, ratio_alpha_src: float
 trg_lang: Optional[str], ratio_words_trg: float, ratio_alpha_trg: float,\
  debug: bool = True) -> None:
     """Cleans the parallel (or monolingual) dataset based on the number of characters"""
+    src_re = char_re(src_lang) if src_lang in CHARS else None
+    trg_re = char_re(trg_lang) if trg_lang in CHARS else None
     for line in stdin:
         fields = line.rstrip('\r\n').split('\t')
         if len(fields) == 1:
@@ -37,7 +38,7 @@ trg_lang: Optional[str], ratio_words_trg: float, ratio_alpha_trg: float,\
         if trg:
             trg = unicodedata.normalize("NFC", trg)
 
-        if src_lang in CHARS:
+        if src_re is not None:
             src_toks = src.split()
             src_len = len(src_toks)
             if src_len==0:
@@ -46,19 +47,19 @@ trg_lang: Optional[str], ratio_words_trg: float, ratio_alpha_trg: float,\
                 continue
 
             num_words = sum(
-                [1 if re.match(CHARS[src_lang], t, re.IGNORECASE) else 0 for t in src_toks])
+                [1 if src_re.match(t) else 0 for t in src_toks])
             if num_words / float(src_len) < ratio_words_src:
                 if debug:
                     stderr.write(f'RATIO_WORDS_SRC\t{src}\t{trg}\n')
                 continue
 
-            char_alpha = len(re.findall(CHARS[src_lang], src, re.IGNORECASE))
+            char_alpha = len(src_re.findall(src))
             if char_alpha / float(len(src.replace(' ', ''))) < ratio_alpha_src:
                 if debug:
                     stderr.write(f'RATIO_ALPHA_SRC\t{src}\t{trg}\n')
                 continue
 
-        if trg is not None and trg_lang in CHARS:
+        if trg is not None and trg_re is not None:
             trg_toks = trg.split()
             trg_len = len(trg_toks)
             if trg_len==0:
@@ -67,13 +68,13 @@ trg_lang: Optional[str], ratio_words_trg: float, ratio_alpha_trg: float,\
                 continue
 
             num_words = sum(
-                [1 if re.match(CHARS[trg_lang], t, re.IGNORECASE) else 0 for t in trg_toks])
+                [1 if trg_re.match(t) else 0 for t in trg_toks])
             if num_words / float(trg_len) < ratio_words_trg:
                 if debug:
                     stderr.write(f'RATIO_WORDS_TRG\t{src}\t{trg}\n')
                 continue
 
-            char_alpha = len(re.findall(CHARS[trg_lang], trg, re.IGNORECASE))
+            char_alpha = len(trg_re.findall(trg))
             if char_alpha / float(len(trg.replace(' ', ''))) < ratio_alpha_trg:
                 if debug:
                     stderr.write(f'RATIO_ALPHA_TRG\t{src}\t{trg}\n')
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 """Common filtering code to be used by various submodules"""
+import re
+from functools import lru_cache
+from typing import IO, AnyStr, Callable, Iterator, List
+
 
 CHARS = {
     'ar': r'[\u0600-\u06FF]', # This is not entirely right, as it also includes farsi symbols and whatnot
-    'bg': r'[АаБбВвГгДддЕеЖжЗзИиЙйКкkasЛлМмНнОоПпРрСсТтУуФфХхЦцЧчШшЩщЪъЬьЮюЯя]',
+    # Bulgarian Cyrillic: а-я without ы and э
+    'bg': r'[А-ЪЬЮЯа-ъьюя]',
     # Bosnian uses Latin script, but excludes [ywxq]
     #   Common diacritics: [čćđšžž]
     'bs': r'[abcdefghijklmnoprstuvzčćđšžž]',
@@ -68,3 +73,48 @@ CHARS = {
     #   Sampled diacritics from HPLT data: 'àảãáạăằẳẵắặâầẩẫấậðđèẻẽéẹêềểễếệìỉĩíịòỏõóọôồổỗốộơờởỡớợùủũúụưừửữứựỳỷỹýỵ'
     'vi': r'[a-zàảãáạăằẳẵắặâầẩẫấậðđèẻẽéẹêềểễếệìỉĩíịòỏõóọôồổỗốộơờởỡớợùủũúụưừửữứựỳỷỹýỵ]',
 }
+
+
+@lru_cache(maxsize=None)
+def char_re(lang: str) -> re.Pattern:
+    """The CHARS pattern for `lang`, compiled case-insensitive like the filters
+    match it. Compiled on first use, so a filter only pays for the languages
+    it uses, and only once instead of looking it up in re's cache for every
+    sentence."""
+    return re.compile(CHARS[lang], re.IGNORECASE)
+
+
+# Number of characters (or bytes) of whole lines in each batch that
+# parallel_filter() hands to its filter function.
+BATCH_SIZE = 2**16
+
+
+def _batches(fin: IO[AnyStr], batch_size: int) -> Iterator[List[AnyStr]]:
+    while lines := fin.readlines(batch_size):
+        yield lines
+
+
+def _write(fout: IO[AnyStr], lines: List[AnyStr]) -> None:
+    """Writes `lines` with a single write() call. With PYTHONUNBUFFERED set,
+    as it often is in containers, writelines() would make a write() syscall
+    for every line."""
+    if lines:
+        fout.write(lines[0][:0].join(lines))
+
+
+def parallel_filter(func: Callable[[List[AnyStr]], List[AnyStr]], fin: IO[AnyStr], fout: IO[AnyStr], jobs: int = 1, *, batch_size: int = BATCH_SIZE) -> None:
+    """Passes the lines of `fin` in batches to `func`, and writes the lines it
+    returns to `fout`. With `jobs` > 1 the batches are spread over that many
+    processes, but the output still comes out in the order of the input.
+    `func` runs in the worker processes, so it has to be picklable: a module
+    level function, or a functools.partial of one."""
+    if jobs <= 1:
+        for batch in _batches(fin, batch_size):
+            _write(fout, func(batch))
+        return
+
+    # Only imported here, most filters never use more than one process.
+    from multiprocessing import Pool
+    with Pool(jobs) as pool:
+        for lines in pool.imap(func, _batches(fin, batch_size)):
+            _write(fout, lines)
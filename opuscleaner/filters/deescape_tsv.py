@@ -1,12 +1,41 @@
 #!/usr/bin/env python3
+import argparse
+import re
 import sys
+from typing import List
 
-QUOTECHR = ord('"')
+from clean_common import parallel_filter
 
-for line in sys.stdin.buffer:
-	fields = line.rstrip(b"\r\n").split(b"\t")
-	for i, field in enumerate(fields):
-		if len(field) > 0 and field[0] == QUOTECHR and field[-1] == QUOTECHR:
-			fields[i] = field[1:-1].replace(b'""', b'"')
-	sys.stdout.buffer.write(b"\t".join(fields))
-	sys.stdout.buffer.write(b"\n")
+# A whole field that starts and ends with a quote. A lone `"` counts too, and
+# becomes an empty field.
+QUOTED_FIELD = re.compile(rb'(?<![^\t\n])"(?:([^\t\n]*)")?(?![^\t\n])')
+
+# Line endings, including any \r in front of them
+LINE_END = re.compile(rb'\r+\n')
+
+
+def unquote(match: re.Match) -> bytes:
+	field = match.group(1)
+	return field.replace(b'""', b'"') if field else b''
+
+
+def deescape_lines(lines: List[bytes]) -> List[bytes]:
+	"""Unquotes the fields of a batch of lines with a single substitution over
+	all of them, instead of a Python loop over every line and field."""
+	if not lines[-1].endswith(b"\n"):
+		lines[-1] += b"\n"
+	chunk = b"".join(lines)
+	if b"\r" in chunk:
+		chunk = LINE_END.sub(b"\n", chunk)
+	if b'"' in chunk:
+		chunk = QUOTED_FIELD.sub(unquote, chunk)
+	return [chunk]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes to unquote lines with')
+	args = parser.parse_args()
+
+	# Batches of about 1MB of lines
+	parallel_filter(deescape_lines, sys.stdin.buffer, sys.stdout.buffer, args.jobs, batch_size=2**20)
@@ -2,18 +2,20 @@
 import os
 import sys
 import argparse
+import tempfile
+from itertools import islice
 from typing import List
 
 # The filename has to have a different name than 'fasttext', otherwise we can't import the module correctly
 import fasttext
 
-from more_itertools import chunked
 import requests
 
 
-def download_model(model_type: str):
+def download_model(model_type: str) -> str:
     """
-    Downloads the fasttext model for language identification to local directory. Either the large one or the small one.
+    Downloads the fasttext model for language identification to the cache directory, unless it is there already.
+    Either the large one or the small one. Returns the path to the model.
     """
     if model_type == "small":
         url = "https://dl.fbaipublicfiles.com/fasttext/supervised-models/lid.176.ftz"
@@ -22,30 +24,43 @@ def download_model(model_type: str):
     else:
         raise TypeError("Fasttext model type has to be either 'small' or 'large'.")
     file_name = model_type + ".bin"
-    # Do not download twice
+    # Models downloaded by earlier versions, to the working directory
     if os.path.exists(file_name):
-        return
-    response = requests.get(url)
-    with open(file_name, "wb") as handle:
-        handle.write(response.content)
+        return file_name
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "opuscleaner", "fasttext")
+    path = os.path.join(cache_dir, file_name)
+    # Do not download twice
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache_dir, exist_ok=True)
+    # Stream to a temporary file and move it into place once complete. The large model is over 1GB, and another
+    # process running this filter at the same time should never see half a model.
+    with requests.get(url, stream=True) as response, \
+         tempfile.NamedTemporaryFile(dir=cache_dir, prefix=file_name, suffix=".part", delete=False) as handle:
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=2**20):
+                handle.write(chunk)
+        except BaseException:
+            os.unlink(handle.name)
+            raise
+    os.replace(handle.name, path)
+    return path
 
 
-def verify_lang(model: fasttext.FastText._FastText, texts: List[str], desired_lang: str, debug: bool) -> List[bool]:
+def top_langs(model: fasttext.FastText._FastText, texts: List[str]) -> List[str]:
     # Langs is a list of list - for each row we get a list of identified languages, sorted by their probability.
     # Future work - using `model.predict(texts, k=10)` get the 10 most probable languages
     #   and do some clever filtering based on the distribution.
     langs, probs = model.predict(texts)
-
-    if debug:
-        sys.stderr.write(f"LANGUAGES\t{[lang[0] for lang in langs]}\n")
-    return [row_langs[0] == desired_lang for row_langs in langs]
+    return [row_langs[0] for row_langs in langs]
 
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--source-lang", type=str, help="Code of the desired source language.")
     parser.add_argument("--target-lang", type=str, help="Code of the desired target language.")
-    parser.add_argument("--batch-size", type=int, default=16, help="Size of the batch to send the data to fasttext.")
+    parser.add_argument("--batch-size", type=int, default=4096, help="Size of the batch to send the data to fasttext.")
     parser.add_argument("--debug", action="store_true")
     parser.add_argument(
         "--model-type",
@@ -56,18 +71,22 @@ def main():
     # Fastext way to encode language codes
     source_lang = "__label__" + args.source_lang
     target_lang = "__label__" + args.target_lang
-    download_model(args.model_type)
+    model_path = download_model(args.model_type)
     # Disable fasttext to notify us about loading the model
     fasttext.FastText.eprint = lambda x: None
-    model = fasttext.load_model(f"{args.model_type}.bin")
-    for batch in chunked(sys.stdin, args.batch_size):
+    model = fasttext.load_model(model_path)
+    while batch := list(islice(sys.stdin, args.batch_size)):
         # Remove newlines
         batch = [row.rstrip("\r\n") for row in batch]
         sources, targets = zip(*[row.split("\t", 1) for row in batch])
-        sources_ok = verify_lang(model, list(sources), source_lang, args.debug)
-        targets_ok = verify_lang(model, list(targets), target_lang, args.debug)
-        for row, source_ok, target_ok in zip(batch, sources_ok, targets_ok):
-            if source_ok and target_ok:
+        # One predict() call for both sides: the sources, then the targets
+        langs = top_langs(model, [*sources, *targets])
+        source_langs, target_langs = langs[:len(batch)], langs[len(batch):]
+        if args.debug:
+            sys.stderr.write(f"LANGUAGES\t{source_langs}\n")
+            sys.stderr.write(f"LANGUAGES\t{target_langs}\n")
+        for row, row_source_lang, row_target_lang in zip(batch, source_langs, target_langs):
+            if row_source_lang == source_lang and row_target_lang == target_lang:
                 sys.stdout.write(row + "\n")
 
 
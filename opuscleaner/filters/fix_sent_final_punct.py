@@ -1,40 +1,69 @@
 #!/usr/bin/env python3
+import argparse
 import sys
+from typing import List, Tuple
 
-my_punct = {'!', '"', '#', '$', '%', '&', "'", '(', ')', '*', '+', ',', '.', '/', ':', ';', '<', '=', '>', '?', '@', '[', '\\', ']', '^', '_', '`', '{', '|', '}', '~', '»', '«', '“', '”'}
+from clean_common import parallel_filter
 
-for line in sys.stdin:
-    src, trg = line.rstrip("\r\n").split("\t")
-    if len(src) == 0 or len(trg) == 0:
-        print(src + '\t' + trg)
-        continue
+my_punct = frozenset({'!', '"', '#', '$', '%', '&', "'", '(', ')', '*', '+', ',', '.', '/', ':', ';', '<', '=', '>', '?', '@', '[', '\\', ']', '^', '_', '`', '{', '|', '}', '~', '»', '«', '“', '”'})
 
+FRENCH_QUOTES = frozenset({'»', '«'})
+
+DASHES = frozenset({'–', '—'})
+
+
+def fix(src: str, trg: str) -> Tuple[str, str]:
+    """Fixes the sentence-final punctuation of a non-empty pair of sentences."""
     # Sometimes we have a space between the final letter and the punctuation, which is wrong except if using french quotes
-    if len(src) >= 2 and src[-1] in my_punct and src[-2] == " " and src[-1] != '»' and src[-1] != '«':
+    if len(src) >= 2 and src[-1] in my_punct and src[-2] == " " and src[-1] not in FRENCH_QUOTES:
         src = src[:-2] + src[-1]
-    if len(trg) >= 2 and trg[-1] in my_punct and trg[-2] == " " and trg[-1] != '»' and trg[-1] != '«':
+    if len(trg) >= 2 and trg[-1] in my_punct and trg[-2] == " " and trg[-1] not in FRENCH_QUOTES:
         trg = trg[:-2] + trg[-1]
     # Sometimes two punctuation marks are swapped...
     if len(src) >=2 and len(trg) >= 2 and src[-2] == trg[-1] and src[-1] == trg[-2]:
-       trg = trg[:-2] + src[-2] + src[-1]
+        trg = trg[:-2] + src[-2] + src[-1]
     # Sometimes they are swapped with space around eg SPACE». -> .SPACE»
     if len(src) >=3 and src[-1] in my_punct and src[-2] == '»' and src[-3] == ' ':
-       src = src[:-3] + src[-1] + ' ' + src[-2]
+        src = src[:-3] + src[-1] + ' ' + src[-2]
     if len(trg) >=3 and trg[-1] in my_punct and trg[-2] == '»' and trg[-3] == ' ':
-       trg = trg[:-3] + trg[-1] + ' ' + trg[-2]
+        trg = trg[:-3] + trg[-1] + ' ' + trg[-2]
 
+    # Look the final characters up once for all the cases below
+    src_last, trg_last = src[-1], trg[-1]
+    src_punct, trg_punct = src_last in my_punct, trg_last in my_punct
 
     # check for the french quotes special case
-    if (src[-1] == '»' or src[-1] == '«') and trg[-1] not in my_punct:
+    if src_last in FRENCH_QUOTES and not trg_punct:
         trg = trg + '"'
-    elif (trg[-1] == '»' or trg[-1] == '«') and src[-1] not in my_punct:
+    elif trg_last in FRENCH_QUOTES and not src_punct:
         src = src + '"'
-    elif src[-1] in my_punct and trg[-1] not in my_punct:
-        trg = trg + src[-1]
-    elif trg[-1] in my_punct and src[-1] not in my_punct:
-        src = src + trg[-1]
+    elif src_punct and not trg_punct:
+        trg = trg + src_last
+    elif trg_punct and not src_punct:
+        src = src + trg_last
     # Final case. Fix mismatched punctuation on the src and trg. EXCEPT in cases like french quotes. And in cases where we have emdash at the front, as it means spech
-    elif trg[-1] in my_punct and src[-1] in my_punct and src[-1] != trg[-1] and src[-1] != '»' \
-and src[-1] != '«' and trg[-1] != '»' and trg[-1] != '«' and src[0] != '–' and trg[0] != '–' and src[0] != '—' and trg[0] != '—':
-        trg = trg[:-1] + src[-1]
-    print(src + '\t' + trg)
+    elif trg_punct and src_punct and src_last != trg_last and src_last not in FRENCH_QUOTES \
+            and trg_last not in FRENCH_QUOTES and src[0] not in DASHES and trg[0] not in DASHES:
+        trg = trg[:-1] + src_last
+    return src, trg
+
+
+def fix_lines(lines: List[str]) -> List[str]:
+    fixed: List[str] = []
+    write = fixed.append
+
+    for line in lines:
+        src, trg = line.rstrip("\r\n").split("\t")
+        if len(src) > 0 and len(trg) > 0:
+            src, trg = fix(src, trg)
+        write(f'{src}\t{trg}\n')
+
+    return fixed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes to fix lines with')
+    args = parser.parse_args()
+
+    parallel_filter(fix_lines, sys.stdin, sys.stdout, args.jobs)
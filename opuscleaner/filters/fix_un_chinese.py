@@ -1,16 +1,15 @@
 #!/usr/bin/env python3
 """Legacy fix_un.py from Barry. Need to fix it up a bit."""
-import re
 import sys
 
 
-re_final_comma = re.compile(r"\.$")
+# Sentence-final punctuation that should be an ideographic full stop
+FINAL_STOPS = ('，', '.')
 
 
 for line in sys.stdin:
     line = line.strip()
-    if line[-1] == '，':
+    if line.endswith(FINAL_STOPS):
         line = line[:-1] + "\u3002"
     line = line.replace(",", "\uFF0C")
-    line = re_final_comma.sub("\u3002", line)
     print(line)
@@ -2,7 +2,10 @@
 import argparse
 import re
 import sys
-from typing import Match, TextIO
+from functools import lru_cache, partial
+from typing import List, Match, TextIO
+
+from clean_common import parallel_filter
 
 
 NUM_EXPR = re.compile(r"""
@@ -18,17 +21,42 @@ NUM_EXPR = re.compile(r"""
 """, re.X)
 
 
+# Any digit. Lines without one can't have a number mismatch, and searching for
+# this is a lot cheaper than for NUM_EXPR.
+DIGIT = re.compile(r'\d')
+
+
+# Decimal and digit separators, which we ignore when comparing
+NONDIGITS = re.compile(r'[^\d]+')
+
+
+# The same numbers come back over and over in a corpus, so remember how they
+# normalize instead of running a substitution for each one.
+@lru_cache(maxsize=2**16)
+def normalize_value(value:str) -> str:
+	return NONDIGITS.sub('*', value)
+
+
 def normalize(numstr:Match) -> str:
-	return (numstr['sign'] or '') + re.sub(r'[^\d]+', '*', numstr['value']) # ignore the decimal and digit separators
+	return (numstr['sign'] or '') + normalize_value(numstr['value'])
+
+
+def filter_lines(lines: List[str], ratio: float, *, debug: bool = False) -> List[str]:
+	accepted = []
 
+	for line in lines:
+		assert '\t' in line # at least two columns
 
-def filter_numerical_mismatch(fin: TextIO, fout: TextIO, ratio: float, *, debug: bool = False):
-	for line in fin:
-		cols = line.rstrip('\r').split('\t')
+		if not DIGIT.search(line):
+			accepted.append(line)
+			continue
 
-		assert len(cols) >= 2
+		# Only the first two columns matter. A trailing \r or \n doesn't
+		# change what NUM_EXPR matches, so no need to strip it.
+		left, _, rest = line.partition('\t')
+		right = rest.partition('\t')[0]
 
-		nums_left, nums_right = (set(map(normalize, re.finditer(NUM_EXPR, col))) for col in cols[:2])
+		nums_left, nums_right = (set(map(normalize, NUM_EXPR.finditer(col))) for col in (left, right))
 
 		# Only bother calculating the ratio if there were any numbers to begin with
 		if nums_left or nums_right:
@@ -44,13 +72,20 @@ def filter_numerical_mismatch(fin: TextIO, fout: TextIO, ratio: float, *, debug:
 			if line_ratio < ratio:
 				continue
 
-		fout.write(line)
+		accepted.append(line)
+
+	return accepted
+
+
+def filter_numerical_mismatch(fin: TextIO, fout: TextIO, ratio: float, *, debug: bool = False, jobs: int = 1):
+	parallel_filter(partial(filter_lines, ratio=ratio, debug=debug), fin, fout, jobs)
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--ratio', type=float, default=1.0)
 	parser.add_argument('--debug', action='store_true')
+	parser.add_argument('--jobs', '-j', type=int, default=1, help='Number of processes to filter with')
 	args = parser.parse_args()
 
-	filter_numerical_mismatch(sys.stdin, sys.stdout, args.ratio, debug=args.debug)
+	filter_numerical_mismatch(sys.stdin, sys.stdout, args.ratio, debug=args.debug, jobs=args.jobs)
@@ -1,16 +1,84 @@
 #!/usr/bin/env python3
 import sys
+from typing import List
+
+# Bytes read from stdin at a time
+CHUNK_SIZE = 2**20
+
+# Bytes that occur in the UTF-8 encoding of a whitespace character: ASCII
+# whitespace, and the lead and continuation bytes of characters such as U+00A0
+# or U+3000. A field with any other byte in it can't be blank. Most text in a
+# non-Latin script has plenty of those, so only its blank fields are suspect.
+# (Python's whitespace characters are all in the Basic Multilingual Plane.)
+MAYBE_SPACE = bytes(sorted({
+    byte
+    for char in map(chr, range(0x10000)) if char.isspace()
+    for byte in char.encode()
+}))
+
+# Reduces a block to `x` for every byte that can't be whitespace, and the tabs
+# and newlines that separate the fields. A field that might be blank then shows
+# up as two separators next to each other. Turning the newlines into tabs as
+# well lets a single search find all of those.
+SUSPECT_TABLE = bytes(b if b in b'\t\n' else ord('x') for b in range(256))
+SUSPECT_DELETE = bytes(b for b in MAYBE_SPACE if b not in b'\t\n')
+NEWLINE_TO_TAB = bytes.maketrans(b'\n', b'\t')
+
+
+def is_blank(field: bytes) -> bool:
+    return not field.translate(None, MAYBE_SPACE) \
+        and not field.decode('utf-8', errors='replace').strip()
+
+
+def keep(line: bytes) -> bool:
+    return not any(map(is_blank, line.split(b'\t')))
+
+
+def suspect_lines(block: bytes) -> List[int]:
+    """Indices of the lines in `block` that might have a blank field."""
+    reduced = b'\n' + block.translate(SUSPECT_TABLE, SUSPECT_DELETE)
+    separators = reduced.translate(NEWLINE_TO_TAB)
+    offsets = []
+    offset = separators.find(b'\t\t')
+    while offset != -1:
+        offsets.append(offset)
+        offset = separators.find(b'\t\t', offset + 1)
+    # Line of the separator at each offset, or the line it starts if it is
+    # a newline (the one put in front of `reduced` starts the first line.)
+    indices = []
+    line, prev = -1, 0
+    for offset in offsets:
+        line += reduced.count(b'\n', prev, offset + 1)
+        prev = offset + 1
+        if not indices or indices[-1] != line:
+            indices.append(line)
+    return indices
+
+
+def filter_lines(block: bytes) -> bytes:
+    """Removes the lines with a blank field from `block`, which ends with a
+    newline. Most blocks have no suspect lines and are returned as they are."""
+    indices = suspect_lines(block)
+    if not indices:
+        return block
+    lines = block.split(b'\n')
+    for index in reversed(indices):
+        if not keep(lines[index]):
+            del lines[index]
+    return b'\n'.join(lines)
+
 
 def main():
-    for line in sys.stdin:
-        fields = line.strip("\r\n").split("\t")
-        ok = True
-        for field in fields:
-            if not field.strip():
-                ok = False
-                break
-        if ok:
-            sys.stdout.write(line)
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    remainder = b''
+    while chunk := stdin.read(CHUNK_SIZE):
+        block = remainder + chunk
+        cut = block.rfind(b'\n') + 1
+        remainder = block[cut:]
+        if cut:
+            stdout.write(filter_lines(block[:cut]))
+    if remainder and keep(remainder):
+        stdout.write(remainder)
 
 if __name__ == '__main__':
     main()
@@ -1,24 +1,16 @@
 #!/usr/bin/env python3
+import os
 import sys
 import argparse
 from collections import deque, Counter
-from typing import Iterable, TypeVar
-from itertools import takewhile
+from typing import Collection, Iterable
 
 
-def common_suffix(buffer: Iterable[str]) -> str:
-	iters = [iter(line[::-1]) for line in buffer]
-	assert len(iters) > 1
-	suffix = takewhile(identical, zip(*iters))
-	return "".join(t[0] for t in suffix)[::-1]
-
-
-T = TypeVar('T')
-
-def identical(elements: Iterable[T]) -> bool:
-	it = iter(elements)
-	first = next(it)
-	return all(first == el for el in it)
+def common_suffix(buffer: Collection[str]) -> str:
+	assert len(buffer) > 1
+	# commonprefix() only compares the lexicographically smallest and largest
+	# of the reversed lines, which share the prefix all of them share.
+	return os.path.commonprefix([line[::-1] for line in buffer])[::-1]
 
 
 def strip_suffix(lines: Iterable[str], *, minlen: int = 2, minocc: int = 5, counter: Counter=None) -> Iterable[str]:
@@ -0,0 +1,58 @@
+import io
+import os
+import sys
+import random
+import subprocess
+import unittest
+from typing import List
+
+from clean_common import parallel_filter
+
+
+FILTERS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def upper(lines:List[str]) -> List[str]:
+	return [line.upper() for line in lines]
+
+
+def make_input(n:int) -> str:
+	"""Sentence pairs with numbers, quotes and sentence-final punctuation for
+	the filters to work on"""
+	rng = random.Random(1)
+	lines = []
+	for i in range(n):
+		src = f'There are {i} cows{rng.choice([".", "!", "?", ""])}'
+		trg = f'Er zijn {rng.choice([i, i + 1])} koeien{rng.choice([".", "!", "?", ""])}'
+		if i % 3 == 0:
+			src = '"' + src.replace('cows', '""cows""') + '"'
+		lines.append(f'{src}\t{trg}\n')
+	return ''.join(lines)
+
+
+class TestParallelFilter(unittest.TestCase):
+	def test_order(self):
+		"""Output comes out in the order of the input, whatever the number of jobs"""
+		lines = make_input(1000)
+		for jobs in [1, 4]:
+			with self.subTest(jobs=jobs):
+				fout = io.StringIO()
+				parallel_filter(upper, io.StringIO(lines), fout, jobs, batch_size=100)
+				self.assertEqual(fout.getvalue(), lines.upper())
+
+	def test_filters(self):
+		"""Filters that take --jobs produce the same output with one or more"""
+		lines = make_input(50000) # more than one batch, even for deescape_tsv
+		for command in [['num_mismatch.py', '--ratio', '1.0'], ['fix_sent_final_punct.py'], ['deescape_tsv.py']]:
+			with self.subTest(command=command[0]):
+				outputs = [
+					subprocess.run([sys.executable, *command, '--jobs', str(jobs)],
+						cwd=FILTERS_PATH,
+						input=lines,
+						text=True,
+						capture_output=True,
+						check=True).stdout
+					for jobs in [1, 4]
+				]
+				self.assertNotEqual(outputs[0], '')
+				self.assertEqual(outputs[0], outputs[1])
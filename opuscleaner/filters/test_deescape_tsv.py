@@ -0,0 +1,47 @@
+import io
+import random
+import unittest
+
+from deescape_tsv import deescape_lines
+
+
+def reference(data:bytes) -> bytes:
+	"""What deescape_tsv used to do, one line and field at a time."""
+	out = []
+	for line in io.BytesIO(data):
+		fields = line.rstrip(b"\r\n").split(b"\t")
+		for i, field in enumerate(fields):
+			if len(field) > 0 and field[0] == ord('"') and field[-1] == ord('"'):
+				fields[i] = field[1:-1].replace(b'""', b'"')
+		out.append(b"\t".join(fields) + b"\n")
+	return b"".join(out)
+
+
+class TestDeescapeTsv(unittest.TestCase):
+	def assertDeescaped(self, data:bytes):
+		lines = io.BytesIO(data).readlines()
+		self.assertEqual(b"".join(deescape_lines(lines)), reference(data))
+
+	def test_quoted(self):
+		self.assertEqual(deescape_lines([b'"Hello ""world"""\tHallo\n']), [b'Hello "world"\tHallo\n'])
+
+	def test_unquoted(self):
+		"""Fields that don't both start and end with a quote stay as they are"""
+		self.assertDeescaped(b'"Hello\tHallo"\n5" screen\t"5""\n')
+
+	def test_lone_quote(self):
+		"""A field that is just a quote becomes empty"""
+		self.assertEqual(deescape_lines([b'"\t""\t"""\n']), [b'\t\t"\n'])
+
+	def test_line_endings(self):
+		"""CRLF becomes LF, and the last line gets a newline"""
+		self.assertDeescaped(b'"a"\r\nb\r\r\n"c"\r')
+
+	def test_random(self):
+		"""Same output as unquoting every field by itself"""
+		rng = random.Random(1)
+		chars = [b'a', b'"', b'""', b'\t', b'\n', b'\r', b' ']
+		for _ in range(500):
+			data = b''.join(rng.choice(chars) for _ in range(rng.randrange(1, 50)))
+			with self.subTest(data=data):
+				self.assertDeescaped(data)
@@ -0,0 +1,74 @@
+import random
+import unittest
+
+from fix_sent_final_punct import fix_lines
+
+
+my_punct = {'!', '"', '#', '$', '%', '&', "'", '(', ')', '*', '+', ',', '.', '/', ':', ';', '<', '=', '>', '?', '@', '[', '\\', ']', '^', '_', '`', '{', '|', '}', '~', '»', '«', '“', '”'}
+
+
+def reference(line:str) -> str:
+	"""What fix_sent_final_punct used to do to a line."""
+	src, trg = line.rstrip("\r\n").split("\t")
+	if len(src) == 0 or len(trg) == 0:
+		return src + '\t' + trg + '\n'
+	if len(src) >= 2 and src[-1] in my_punct and src[-2] == " " and src[-1] != '»' and src[-1] != '«':
+		src = src[:-2] + src[-1]
+	if len(trg) >= 2 and trg[-1] in my_punct and trg[-2] == " " and trg[-1] != '»' and trg[-1] != '«':
+		trg = trg[:-2] + trg[-1]
+	if len(src) >=2 and len(trg) >= 2 and src[-2] == trg[-1] and src[-1] == trg[-2]:
+		trg = trg[:-2] + src[-2] + src[-1]
+	if len(src) >=3 and src[-1] in my_punct and src[-2] == '»' and src[-3] == ' ':
+		src = src[:-3] + src[-1] + ' ' + src[-2]
+	if len(trg) >=3 and trg[-1] in my_punct and trg[-2] == '»' and trg[-3] == ' ':
+		trg = trg[:-3] + trg[-1] + ' ' + trg[-2]
+	if (src[-1] == '»' or src[-1] == '«') and trg[-1] not in my_punct:
+		trg = trg + '"'
+	elif (trg[-1] == '»' or trg[-1] == '«') and src[-1] not in my_punct:
+		src = src + '"'
+	elif src[-1] in my_punct and trg[-1] not in my_punct:
+		trg = trg + src[-1]
+	elif trg[-1] in my_punct and src[-1] not in my_punct:
+		src = src + trg[-1]
+	elif trg[-1] in my_punct and src[-1] in my_punct and src[-1] != trg[-1] and src[-1] != '»' \
+		and src[-1] != '«' and trg[-1] != '»' and trg[-1] != '«' and src[0] != '–' and trg[0] != '–' and src[0] != '—' and trg[0] != '—':
+		trg = trg[:-1] + src[-1]
+	return src + '\t' + trg + '\n'
+
+
+class TestFixSentFinalPunct(unittest.TestCase):
+	def assertFixed(self, line:str, expected:str):
+		self.assertEqual(fix_lines([line]), [expected])
+		self.assertEqual(reference(line), expected)
+
+	def test_space(self):
+		"""A space before the final punctuation is removed"""
+		self.assertFixed('Hello !\tHallo!\n', 'Hello!\tHallo!\n')
+
+	def test_missing(self):
+		"""Punctuation missing on one side is copied from the other"""
+		self.assertFixed('Hello.\tHallo\n', 'Hello.\tHallo.\n')
+		self.assertFixed('Hello\tHallo?\r\n', 'Hello?\tHallo?\n')
+
+	def test_mismatch(self):
+		"""Mismatched punctuation follows the source, except after a dash"""
+		self.assertFixed('Hello!\tHallo.\n', 'Hello!\tHallo!\n')
+		self.assertFixed('— Hello!\tHallo.\n', '— Hello!\tHallo.\n')
+
+	def test_french_quotes(self):
+		self.assertFixed('« Bonjour »\tHello\n', '« Bonjour »\tHello"\n')
+		self.assertFixed('Bonjour ».\tHello.\n', 'Bonjour. »\tHello.\n')
+
+	def test_empty(self):
+		self.assertFixed('\tHallo\n', '\tHallo\n')
+
+	def test_random(self):
+		"""Same output as the line by line version"""
+		rng = random.Random(1)
+		chars = ['a', ' ', '.', '!', '?', '"', '»', '«', '“', '–', '—']
+		lines = [
+			''.join(rng.choice(chars) for _ in range(rng.randrange(5))) + '\t'
+			+ ''.join(rng.choice(chars) for _ in range(rng.randrange(5))) + '\n'
+			for _ in range(5000)
+		]
+		self.assertEqual(fix_lines(lines), list(map(reference, lines)))
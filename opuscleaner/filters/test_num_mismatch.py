@@ -54,3 +54,13 @@ class TestNumMismatch(unittest.TestCase):
 		self.assertAccept('-30 is the number\tThe number -30', 1.0)
 		self.assertAccept('The-number-30\tThe number 30', 1.0)
 		self.assertReject('Beep-30\tThe number is -30', 1.0)
+
+	def test_no_numbers(self):
+		"""Lines without numbers are accepted as they are."""
+		self.assertAccept('There are cows\tDaar zijn koeien\n', 1.0)
+
+	def test_single_column(self):
+		"""Lines need two columns, whether they contain numbers or not."""
+		for line in ['There are 74 cows\n', 'There are cows\n']:
+			with self.subTest(line=line), self.assertRaises(AssertionError):
+				self._test(line, 1.0)
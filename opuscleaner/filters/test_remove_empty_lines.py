@@ -0,0 +1,67 @@
+import io
+import random
+import sys
+import unittest
+from unittest.mock import patch
+
+import remove_empty_lines
+from remove_empty_lines import filter_lines, keep
+
+
+def reference(lines:str) -> str:
+	"""What remove_empty_lines used to do, one line at a time. Like stdin in
+	text mode on POSIX, it only splits lines at newlines."""
+	return ''.join(
+		line
+		for line in io.StringIO(lines, newline='\n')
+		if all(field.strip() for field in line.strip('\r\n').split('\t'))
+	)
+
+
+class TestRemoveEmptyLines(unittest.TestCase):
+	def assertFiltered(self, lines:str):
+		self.assertEqual(filter_lines(lines.encode()).decode(), reference(lines))
+
+	def test_keep(self):
+		self.assertTrue(keep(b'Hello\tHallo'))
+		self.assertTrue(keep('中文\tрусский'.encode()))
+
+	def test_empty(self):
+		"""Empty fields, at the start, end or in between, are removed"""
+		for line in ['', '\tHallo', 'Hello\t', 'a\t\tb', '\t']:
+			with self.subTest(line=line):
+				self.assertFalse(keep(line.encode()))
+
+	def test_whitespace(self):
+		"""Fields with just whitespace are empty, including non-ASCII whitespace"""
+		for space in [' ', '\r', '\x0b', '\x1c', '\x85', '\xa0', ' ', '　']:
+			with self.subTest(space=space):
+				self.assertFalse(keep(f'Hello\t{space}'.encode()))
+				self.assertTrue(keep(f'Hello\t{space}Hallo{space}'.encode()))
+
+	def test_block(self):
+		"""Only the lines with an empty field are removed from a block"""
+		self.assertFiltered('Hello\tHallo\n\tHallo\nHello\t \n\n中文\tрусский\nBye\tDoei\n')
+		self.assertFiltered('\n\n\n')
+		self.assertFiltered('Hello\tHallo\r\n \tHallo\r\n')
+
+	def test_random(self):
+		"""Same output as checking every line by itself"""
+		rng = random.Random(1)
+		chars = ['a', '中', 'я', ' ', '\t', '\n', '\r', '\xa0', '　', '\x85', '—']
+		for _ in range(200):
+			lines = ''.join(rng.choice(chars) for _ in range(rng.randrange(100))) + '\n'
+			with self.subTest(lines=lines):
+				self.assertFiltered(lines)
+
+	def test_main(self):
+		"""Lines split over chunks and a last line without newline"""
+		lines = 'Hello\tHallo\n\tHallo\nHello\t \n中文\tрусский\n \t\nBye\tDoei'
+		for chunk_size in [1, 2, 3, 7, 1024]:
+			with self.subTest(chunk_size=chunk_size):
+				stdin = io.TextIOWrapper(io.BytesIO(lines.encode()))
+				stdout = io.TextIOWrapper(io.BytesIO())
+				with patch.object(remove_empty_lines, 'CHUNK_SIZE', chunk_size), \
+					patch.object(sys, 'stdin', stdin), patch.object(sys, 'stdout', stdout):
+					remove_empty_lines.main()
+				self.assertEqual(stdout.buffer.getvalue().decode(), reference(lines))
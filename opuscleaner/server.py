@@ -32,7 +32,7 @@ from opuscleaner._util import none_throws
 from opuscleaner.categories import app as categories_app
 from opuscleaner.config import DATA_PATH, FILTER_PATH, COL_PY, SAMPLE_PY, SAMPLE_SIZE
 from opuscleaner.datasets import list_datasets, dataset_path, sample_path, filter_configuration_path, compute_sample
-from opuscleaner.download import app as download_app
+from opuscleaner.download import app as download_app, downloader
 from opuscleaner.filters import filter_format_command, format_shell, get_global_filter, get_global_filters, set_global_filters, list_filters, FilterType, FilterStep, FilterPipeline
 from opuscleaner.sample import sample
 
@@ -119,8 +119,8 @@ async def get_dataset_sample(name:str, columns:List[Tuple[str,Path]]) -> FilterO
     if not os.path.exists(sample_path(name, langs)):
         await compute_sample(name, columns)
 
-    with open(sample_path(name, langs), 'rb') as fh:
-        stdout = fh.read()
+    # Read on a thread so the other requests don't have to wait for the disk
+    stdout = await asyncio.to_thread(Path(sample_path(name, langs)).read_bytes)
 
     return FilterOutput([lang for lang, _ in columns], 0, stdout, bytes())
 
@@ -247,6 +247,7 @@ async def lifespan(app: FastAPI):
     set_global_filters(list_filters(FILTER_PATH))
     yield
     set_global_filters([])
+    downloader.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -1,3 +1,4 @@
+import io
 import sys
 import os
 import unittest
@@ -8,8 +9,11 @@ from typing import List, Iterable
 from pathlib import Path
 from contextlib import ExitStack
 from collections import defaultdict
+from shlex import quote
 from tempfile import TemporaryFile, NamedTemporaryFile
 
+from opuscleaner.clean import split_command, copy_fd
+
 
 TEST_CWD = Path(os.path.join(os.path.dirname(__file__), 'deeper'))
 
@@ -185,3 +189,103 @@ class TestClean(unittest.TestCase):
 						self.assertEqual(set(record['time'].keys()), {'user', 'real', 'sys'})
 						self.assertGreater(record['time']['real'], 0.0)
 
+
+class TestSplitCommand(unittest.TestCase):
+	def test_plain(self):
+		"""Commands without shell syntax are split like sh would"""
+		self.assertEqual(split_command('./deescape_tsv.py'), ['./deescape_tsv.py'])
+		self.assertEqual(split_command('python3 filter.py --ratio 0.8  -j 2'), ['python3', 'filter.py', '--ratio', '0.8', '-j', '2'])
+		self.assertEqual(split_command('cmd \'single quoted\' "double quoted" back\\ slash'), ['cmd', 'single quoted', 'double quoted', 'back slash'])
+
+	def test_shell(self):
+		"""Commands that need a shell are left to the shell"""
+		for command in [
+			'./num_mismatch.py --ratio $RATIO',
+			'./num_mismatch.py ${DEBUG:+--debug}',
+			'cat | ./filter.py',
+			'./filter.py > out.tsv',
+			'./a.py; ./b.py',
+			'./a.py && ./b.py',
+			'echo `date`',
+			'ls *.gz',
+			'cat ~/file',
+			'(./filter.py)',
+			'./filter.py # comment',
+			'./a.py\n./b.py',
+			'LANG=C sort',
+			'cmd \'unbalanced',
+			'',
+		]:
+			with self.subTest(command=command):
+				self.assertIsNone(split_command(command))
+
+	def test_variables(self):
+		"""Plain variable references are filled in like sh would"""
+		variables = {
+			'LANG1': 'en',
+			'EMPTY': '',
+			'PATTERN': 'a "b" $c \\d * [e]',
+			'YAML': 'threshold: 0.5\nunit: word\n',
+		}
+		for command in [
+			'./filter.py -l $LANG1 --ratio ${LANG1}x',
+			'./filter.py $EMPTY "$EMPTY" x$EMPTY',
+			'sed -E "s/${PATTERN}/\\$\\"\\x/g"',
+			'./opusfilter-ersatz.py --quiet "$YAML"',
+			'\'$LANG1\' \\$LANG1',
+		]:
+			with self.subTest(command=command):
+				vars_setter = ''.join(f'{key}={quote(val)}; ' for key, val in variables.items())
+				echo = f'{quote(sys.executable)} -c "import sys, json; print(json.dumps(sys.argv[1:]))"'
+				output = subprocess.check_output(['sh', '-c', f'{vars_setter}{echo} {command}'], text=True)
+				self.assertEqual(split_command(command, variables), json.loads(output))
+
+	def test_variables_shell(self):
+		"""Variables that the shell would do more with are left to the shell"""
+		variables = {'LANG1': 'en', 'WORDS': 'a b', 'GLOB': '*.gz'}
+		for command in [
+			'./filter.py $UNKNOWN',
+			'./filter.py ${LANG1:+--lang $LANG1}',
+			'./filter.py $WORDS',
+			'./filter.py $GLOB',
+			'./filter.py $(echo $LANG1)',
+			'./filter.py "`echo $LANG1`"',
+			'./filter.py "$LANG1',
+		]:
+			with self.subTest(command=command):
+				self.assertIsNone(split_command(command, variables))
+
+
+class TestCopyFd(unittest.TestCase):
+	DATA = bytes(range(256)) * 8192 # 2MB, more than one read in the fallback
+
+	def setUp(self):
+		fin = TemporaryFile()
+		self.addCleanup(fin.close)
+		fin.write(self.DATA)
+		fin.flush()
+		self.fd = fin.fileno()
+
+	def test_file(self):
+		"""Copying to a file, after what was already written to it"""
+		for sendfile in [True, False]:
+			with self.subTest(sendfile=sendfile), TemporaryFile() as fout:
+				fout.write(b'header')
+				self.assertEqual(copy_fd(self.fd, len(self.DATA), fout, sendfile=sendfile), sendfile)
+				fout.write(b'footer')
+				fout.seek(0)
+				self.assertEqual(fout.read(), b'header' + self.DATA + b'footer')
+
+	def test_no_fd(self):
+		"""Falls back to reading and writing for a file without a descriptor"""
+		fout = io.BytesIO()
+		self.assertFalse(copy_fd(self.fd, len(self.DATA), fout))
+		self.assertEqual(fout.getvalue(), self.DATA)
+
+	def test_size(self):
+		"""Only the first `size` bytes are copied, or less if the file is shorter"""
+		for size in [0, 1, 1000, len(self.DATA) + 1000]:
+			with self.subTest(size=size), TemporaryFile() as fout:
+				copy_fd(self.fd, size, fout)
+				fout.seek(0)
+				self.assertEqual(fout.read(), self.DATA[:size])
@@ -5,6 +5,7 @@ from typing import List, Tuple
 from textwrap import dedent
 
 from opuscleaner.config import COL_PY
+from opuscleaner.col import LineBuffer
 
 
 TEST_INPUT = "".join([
@@ -163,3 +164,47 @@ class TestCol(unittest.TestCase):
 		self.assertEqual(retval, 1)
 		self.assertIn('line contains a different number of fields', err)
 		
+
+
+	def test_crlf_col(self):
+		"""Windows line endings don't make it into the subprocess or output"""
+		reproduce = dedent("""
+			import sys
+			for line in sys.stdin.buffer:
+				assert b'\\r' not in line
+				sys.stdout.buffer.write(line)
+		""")
+
+		out, err, retval = self._run(['0', sys.executable, '-u', '-c', reproduce], TEST_INPUT_SANE.replace('\n', '\r\n'))
+		self.assertEqual(out, TEST_INPUT_SANE)
+		self.assertEqual(err, '')
+		self.assertEqual(retval, 0)
+
+
+class TestLineBuffer(unittest.TestCase):
+	def _feed(self, chunks:List[bytes]) -> List[bytes]:
+		buffer = LineBuffer()
+		lines = []
+		for chunk in chunks:
+			lines += buffer.feed(chunk)
+		return lines + buffer.feed(b'')
+
+	def test_chunks(self):
+		"""Lines come out the same however the input is split into chunks"""
+		data = b'Hello\tHallo\nGoodbye\tBye\n\nlast\tline'
+		expected = [b'Hello\tHallo', b'Goodbye\tBye', b'', b'last\tline']
+		for size in range(1, len(data) + 1):
+			with self.subTest(size=size):
+				chunks = [data[n:n+size] for n in range(0, len(data), size)]
+				self.assertEqual(self._feed(chunks), expected)
+
+	def test_trailing_newline(self):
+		"""A newline at the end of the input doesn't add an empty line"""
+		self.assertEqual(self._feed([b'a\tb\n', b'c\td\n']), [b'a\tb', b'c\td'])
+
+	def test_crlf(self):
+		"""Windows line endings are removed, also when the \\r and \\n end up in
+		different chunks."""
+		self.assertEqual(self._feed([b'a\tb\r\nc\td\r\n']), [b'a\tb', b'c\td'])
+		self.assertEqual(self._feed([b'a\tb\r', b'\nc\td\n']), [b'a\tb', b'c\td'])
+		self.assertEqual(self._feed([b'a\tb', b'\r', b'\n', b'c\td\r']), [b'a\tb', b'c\td'])
@@ -0,0 +1,284 @@
+import os
+import gzip
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from tempfile import TemporaryDirectory
+from typing import List, Dict
+from unittest.mock import patch
+from urllib.error import HTTPError
+from zipfile import BadZipFile, ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from opuscleaner import download
+from opuscleaner.download import HTTPRangeReader, _download_resumable, _open_archive, _copy_deflated, _copy_stored
+
+
+DATA = bytes(range(256)) * 4096 # 1MB
+
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+	"""Serves the data of its server at any path. How it answers depends on
+	the `mode` of that server:
+	- full: always all of it, without mentioning range support
+	- range: the range asked for, unless `If-Range` doesn't match
+	- 416: never anything but 416 Range Not Satisfiable
+	- 416-once: like range, but the first request gets a 416
+	- drop: like range, but the first request loses its connection halfway
+	- no-head: like range, but HEAD requests get a 405 Method Not Allowed"""
+	protocol_version = 'HTTP/1.1'
+
+	server: 'Server'
+
+	def log_message(self, *args) -> None:
+		pass
+
+	def do_HEAD(self) -> None:
+		if self.server.mode == 'no-head':
+			self.send_response(405)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		self._respond(body=False)
+
+	def do_GET(self) -> None:
+		self._respond(body=True)
+
+	def _respond(self, body:bool) -> None:
+		self.server.requests.append(dict(self.headers))
+		first = len(self.server.requests) == 1
+		mode = self.server.mode
+		data = self.server.data
+
+		if mode == '416' or (mode == '416-once' and first):
+			self.send_response(416)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		start, end = 0, len(data)
+		status = 200
+		if mode != 'full' and 'Range' in self.headers \
+			and self.headers.get('If-Range', ETAG) == ETAG:
+			first_byte, _, last_byte = self.headers['Range'].removeprefix('bytes=').partition('-')
+			start = int(first_byte)
+			end = int(last_byte) + 1 if last_byte else len(data)
+			status = 206
+
+		self.send_response(status)
+		self.send_header('Content-Length', str(end - start))
+		self.send_header('ETag', ETAG)
+		if mode != 'full':
+			self.send_header('Accept-Ranges', 'bytes')
+		if status == 206:
+			self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(data)}')
+		self.end_headers()
+
+		if not body:
+			return
+
+		if mode == 'drop' and first:
+			self.wfile.write(data[start:(start + end) // 2])
+			self.close_connection = True
+		else:
+			self.wfile.write(data[start:end])
+
+
+class Server(ThreadingHTTPServer):
+	mode: str
+	data: bytes
+	requests: List[Dict[str,str]]
+
+	def __init__(self, mode:str, data:bytes=DATA):
+		super().__init__(('127.0.0.1', 0), Handler)
+		self.mode = mode
+		self.data = data
+		self.requests = []
+
+	@property
+	def url(self) -> str:
+		return f'http://127.0.0.1:{self.server_address[1]}/data.gz'
+
+
+class ServerTestCase(unittest.TestCase):
+	def serve(self, mode:str, data:bytes=DATA) -> Server:
+		server = Server(mode, data)
+		thread = Thread(target=server.serve_forever)
+		thread.start()
+		def stop():
+			server.shutdown()
+			thread.join()
+			server.server_close()
+		self.addCleanup(stop)
+		return server
+
+
+@patch.object(download, 'DOWNLOAD_RETRY_DELAY', 0)
+class TestDownloadResumable(ServerTestCase):
+	def setUp(self):
+		tempdir = TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		self.dest = os.path.join(tempdir.name, 'out.gz')
+
+	def assertDownloaded(self):
+		with open(self.dest, 'rb') as fh:
+			self.assertEqual(fh.read(), DATA)
+		self.assertFalse(os.path.exists(f'{self.dest}.part'))
+		self.assertFalse(os.path.exists(f'{self.dest}.part.validator'))
+
+	def write_part(self, data:bytes, validator:str) -> None:
+		with open(f'{self.dest}.part', 'wb') as fh:
+			fh.write(data)
+		with open(f'{self.dest}.part.validator', 'w') as fh:
+			fh.write(validator)
+
+	def test_complete(self):
+		"""200: the whole file in one go."""
+		server = self.serve('range')
+		_download_resumable(server.url, self.dest)
+		self.assertDownloaded()
+		self.assertEqual(len(server.requests), 1)
+		self.assertNotIn('Range', server.requests[0])
+
+	def test_resume(self):
+		"""206: a partial download of the same file is continued."""
+		server = self.serve('range')
+		self.write_part(DATA[:1000], ETAG)
+		_download_resumable(server.url, self.dest)
+		self.assertDownloaded()
+		self.assertEqual(server.requests[0]['Range'], 'bytes=1000-')
+		self.assertEqual(server.requests[0]['If-Range'], ETAG)
+
+	def test_resume_changed(self):
+		"""200: a partial download of a file that since changed is replaced."""
+		server = self.serve('range')
+		self.write_part(b'x' * 1000, '"v0"')
+		_download_resumable(server.url, self.dest)
+		self.assertDownloaded()
+
+	def test_range_not_satisfiable(self):
+		"""416: the partial download is discarded and we start over."""
+		server = self.serve('416-once')
+		self.write_part(DATA[:1000], ETAG)
+		_download_resumable(server.url, self.dest)
+		self.assertDownloaded()
+		self.assertEqual(len(server.requests), 2)
+		self.assertNotIn('Range', server.requests[1])
+
+	def test_range_never_satisfiable(self):
+		"""416 every time: gives up without leaving anything behind."""
+		server = self.serve('416')
+		self.write_part(DATA[:1000], ETAG)
+		with self.assertRaises(HTTPError) as context:
+			_download_resumable(server.url, self.dest)
+		self.assertEqual(context.exception.code, 416)
+		self.assertEqual(len(server.requests), download.DOWNLOAD_ATTEMPTS)
+		for path in [self.dest, f'{self.dest}.part', f'{self.dest}.part.validator']:
+			self.assertFalse(os.path.exists(path), path)
+
+	def test_dropped_connection(self):
+		"""A download that breaks off halfway continues where it stopped."""
+		server = self.serve('drop')
+		_download_resumable(server.url, self.dest)
+		self.assertDownloaded()
+		self.assertEqual(len(server.requests), 2)
+		self.assertEqual(server.requests[1]['Range'], f'bytes={len(DATA) // 2}-')
+
+
+class TestHTTPRangeReader(ServerTestCase):
+	def test_no_range_support(self):
+		"""No reader for a server that doesn't say it supports ranges."""
+		server = self.serve('full')
+		self.assertIsNone(HTTPRangeReader.open(server.url))
+
+	def test_no_head(self):
+		"""No reader either for a server that refuses HEAD requests."""
+		server = self.serve('no-head')
+		self.assertIsNone(HTTPRangeReader.open(server.url))
+
+	def test_read(self):
+		"""Reads anywhere in the file, including across the start of the tail."""
+		server = self.serve('range')
+		reader = HTTPRangeReader.open(server.url)
+		self.assertIsNotNone(reader)
+		self.assertEqual(reader.size, len(DATA))
+
+		for offset, length in [(0, 10), (12345, 100000), (len(DATA) - 100, 100), (len(DATA) - HTTPRangeReader.TAIL_SIZE - 10, 20)]:
+			with self.subTest(offset=offset, length=length):
+				self.assertEqual(reader.seek(offset), offset)
+				self.assertEqual(reader.read(length), DATA[offset:offset + length])
+				self.assertEqual(reader.tell(), offset + length)
+
+		reader.seek(-10, os.SEEK_END)
+		self.assertEqual(reader.read(100), DATA[-10:])
+		self.assertEqual(reader.read(100), b'')
+
+	def make_archive(self) -> bytes:
+		with TemporaryDirectory() as tempdir:
+			path = os.path.join(tempdir, 'archive.zip')
+			with ZipFile(path, 'w') as archive:
+				archive.writestr('a.txt', DATA, compress_type=ZIP_STORED)
+				archive.writestr('b.txt', b'hello', compress_type=ZIP_STORED)
+			with open(path, 'rb') as fh:
+				return fh.read()
+
+	def test_zipfile(self):
+		"""Reading a zip archive in the tail and the middle of the file."""
+		server = self.serve('range', self.make_archive())
+		with ZipFile(HTTPRangeReader.open(server.url)) as archive:
+			self.assertEqual(archive.read('a.txt'), DATA)
+			self.assertEqual(archive.read('b.txt'), b'hello')
+
+	def test_open_archive_no_head(self):
+		"""Without a reader, the archive is downloaded in full instead."""
+		server = self.serve('no-head', self.make_archive())
+		with _open_archive(server.url) as open_archive, ZipFile(open_archive()) as archive:
+			self.assertEqual(archive.read('a.txt'), DATA)
+			self.assertEqual(archive.read('b.txt'), b'hello')
+
+
+class TestCopyMember(unittest.TestCase):
+	def setUp(self):
+		tempdir = TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		self.tempdir = tempdir.name
+		self.archive = os.path.join(tempdir.name, 'archive.zip')
+		with ZipFile(self.archive, 'w') as archive:
+			archive.writestr('deflated.txt', DATA, compress_type=ZIP_DEFLATED)
+			archive.writestr('stored.txt', DATA, compress_type=ZIP_STORED)
+			archive.writestr('empty.txt', b'', compress_type=ZIP_DEFLATED)
+
+	def info(self, name:str):
+		with ZipFile(self.archive) as archive:
+			return archive.getinfo(name)
+
+	def open_archive(self):
+		return open(self.archive, 'rb')
+
+	def test_copy_deflated(self):
+		for name in ['deflated.txt', 'empty.txt']:
+			with self.subTest(name=name):
+				dest = _copy_deflated(self.open_archive, self.info(name), os.path.join(self.tempdir, f'{name}.gz'))
+				with gzip.open(dest) as fh:
+					self.assertEqual(fh.read(), DATA if name == 'deflated.txt' else b'')
+
+	def test_copy_deflated_crc(self):
+		"""The CRC-32 from the archive ends up in the gzip trailer, so gzip
+		notices when it doesn't match the data."""
+		info = self.info('deflated.txt')
+		info.CRC ^= 1
+		dest = _copy_deflated(self.open_archive, info, os.path.join(self.tempdir, 'bad.gz'))
+		with gzip.open(dest) as fh, self.assertRaises(gzip.BadGzipFile):
+			fh.read()
+
+	def test_copy_stored(self):
+		dest = _copy_stored(self.open_archive, self.info('stored.txt'), os.path.join(self.tempdir, 'stored.gz'))
+		with gzip.open(dest) as fh:
+			self.assertEqual(fh.read(), DATA)
+
+	def test_copy_stored_crc(self):
+		info = self.info('stored.txt')
+		info.CRC ^= 1
+		with self.assertRaises(BadZipFile):
+			_copy_stored(self.open_archive, info, os.path.join(self.tempdir, 'bad.gz'))